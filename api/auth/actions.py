@@ -1,22 +1,65 @@
+import asyncio
+import functools
+import hashlib
+import time
 from datetime import datetime, timedelta
 from pydantic import EmailStr
 from typing import Union, Optional
-from uuid import UUID
+from uuid import UUID, uuid4
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
+from sqlalchemy import event, or_, bindparam
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from api.auth.cache import (
+    principal_cache,
+    token_revocations,
+    used_refresh_tokens,
+    verified_tokens
+)
+from api.auth.models import AuthUser
 from api.user.models import UserRoles
 from db.crud import UserCRUD
 from db.models import User
-from db.session import get_db
-from settings import ACCESS_TOKEN_EXPIRE_MINUTES, JWT_SECRET_KEY, JWT_ALGORITHM
+from db.session import get_db, async_session
+from settings import (
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    JWT_SECRET_KEY,
+    JWT_ALGORITHM,
+    JWT_CLAIMS_MODE,
+    JWT_REFRESH_SECRET_KEY,
+    REFRESH_TOKEN_EXPIRE_MINUTES,
+    REFRESH_TOKEN_CHECK_VERSION,
+    TOKEN_REVOCATIONS_SYNC_INTERVAL,
+    USED_REFRESH_TOKENS_PURGE_INTERVAL,
+    LOGIN_THROTTLE_ENABLED,
+    LOGIN_THROTTLE_EMAIL_PER_MINUTE,
+    LOGIN_THROTTLE_EMAIL_BURST,
+    LOGIN_THROTTLE_CLIENT_PER_MINUTE,
+    LOGIN_THROTTLE_CLIENT_BURST,
+    LOGIN_THROTTLE_MAX_KEYS
+)
 from utils.hashing import Hasher
+from utils.loggers import get_logger_for_module
+from utils.throttling import InMemoryThrottleStorage, LoginThrottler
+
+
+auth_logger = get_logger_for_module('auth.log')
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/get_token")
+# Для эндпоинтов, где токен нужен не всегда: без заголовка Authorization вернёт None
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/get_token", auto_error=False)
+
+# Для общих лимитов между воркерами заменить storage на реализацию ThrottleStorage
+login_throttler = LoginThrottler(storage=InMemoryThrottleStorage(max_keys=LOGIN_THROTTLE_MAX_KEYS),
+                                 email_per_minute=LOGIN_THROTTLE_EMAIL_PER_MINUTE,
+                                 email_burst=LOGIN_THROTTLE_EMAIL_BURST,
+                                 client_per_minute=LOGIN_THROTTLE_CLIENT_PER_MINUTE,
+                                 client_burst=LOGIN_THROTTLE_CLIENT_BURST,
+                                 enabled=LOGIN_THROTTLE_ENABLED)
 
 
 def create_access_token(data: dict):
@@ -27,75 +70,201 @@ def create_access_token(data: dict):
     return encoded_jwt
 
 
-def check_user_permissions(target_user, current_user) -> bool:
+def decode_access_token(token: str) -> dict:
+    """ jwt.decode с кэшем: повторный токен не разбирается и не проверяется заново до exp """
+    key = hashlib.sha256(token.encode()).digest()
+    payload = verified_tokens.get(key)
+    if payload is None:
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        if "exp" in payload:
+            verified_tokens.set(key, payload, ttl=payload["exp"] - time.time())
+    return payload
+
+
+def create_user_access_token(user) -> str:
+    """ В режиме JWT_CLAIMS_MODE токен содержит всё, что нужно для AuthUser.
+
+    Изменяемый профиль (name, email, ...) в токен не кладётся: он устарел бы
+    после /user/update, а отзывать токены на каждое изменение профиля дорого.
+    """
+    data = {"sub": str(user.user_id), "custom_data": "FHRETEB67EnneE"}
+    if JWT_CLAIMS_MODE:
+        data.update({"ver": user.token_version,
+                     "roles": list(user.roles),
+                     "is_active": user.is_active})
+    return create_access_token(data=data)
+
+
+def create_refresh_token(user_id, token_version: int) -> str:
+    expire = datetime.utcnow() + timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES)
+    to_encode = {"sub": str(user_id),
+                 "ver": token_version,
+                 "jti": uuid4().hex,
+                 "typ": "refresh",
+                 "exp": expire}
+    return jwt.encode(to_encode, JWT_REFRESH_SECRET_KEY, algorithm=JWT_ALGORITHM)
+
+
+async def refresh_tokens(refresh_token: str, db: AsyncSession) -> tuple[str, str]:
+    """ Выдаёт новую пару токенов по refresh токену без проверки пароля.
+
+    Старый refresh токен после использования недействителен (ротация).
+    """
+    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                          detail="Could not validate credentials")
+    try:
+        payload = jwt.decode(refresh_token, JWT_REFRESH_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        user_id: str = payload["sub"]
+        token_version: int = payload["ver"]
+        jti: str = payload["jti"]
+        if payload.get("typ") != "refresh":
+            raise credentials_exception
+    except (JWTError, KeyError):
+        raise credentials_exception
+    if token_revocations.is_revoked(user_id, token_version):
+        raise credentials_exception
+    # Быстрый отказ без запроса в БД, если токен уже предъявлялся в этом воркере
+    if used_refresh_tokens.get(jti) is not None:
+        raise credentials_exception
+    # Общий для всех воркеров и переживающий рестарт реестр - таблица used_refresh_tokens
+    user = await UserCRUD(db).consume_refresh_token(user_id=user_id,
+                                                    jti=jti,
+                                                    expires_at=datetime.utcfromtimestamp(payload["exp"]))
+    if user is None or not user.is_active:
+        raise credentials_exception
+    # В памяти токен помечается только после commit: при откате он остаётся действительным
+    event.listen(db.sync_session, "after_commit",
+                 lambda session: used_refresh_tokens.set(jti, True, ttl=payload["exp"] - time.time()),
+                 once=True)
+    if (JWT_CLAIMS_MODE or REFRESH_TOKEN_CHECK_VERSION) and token_version < user.token_version:
+        raise credentials_exception
+    return create_user_access_token(user), create_refresh_token(user_id=user_id, token_version=token_version)
+
+
+async def purge_used_refresh_tokens() -> None:
+    """ Периодически удаляет jti истёкших refresh токенов: такие токены не пройдут проверку exp """
+    while True:
+        await asyncio.sleep(USED_REFRESH_TOKENS_PURGE_INTERVAL)
+        try:
+            async with async_session() as db:
+                async with db.begin():
+                    await UserCRUD(db).purge_used_refresh_tokens()
+        except Exception as err:
+            auth_logger.error(f'Used refresh tokens purge failed: "{err}"')
+
+
+async def load_token_revocations() -> None:
+    """ Подтягивает отозванные версии токенов из БД: при старте и периодически (sync_token_revocations) """
+    token_lifetime = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    async with async_session() as db:
+        async with db.begin():
+            user_crud = UserCRUD(db)
+            rows = await user_crud.get_token_versions(deleted_within=token_lifetime)
+            await user_crud.purge_deleted_users(deleted_before=token_lifetime)
+    token_revocations.load(rows)
+
+
+async def sync_token_revocations() -> None:
+    """ Отзывы делаются в памяти воркера, выполнившего мутацию; остальные воркеры
+    узнают о них отсюда не позже чем через TOKEN_REVOCATIONS_SYNC_INTERVAL секунд
+    """
+    while True:
+        await asyncio.sleep(TOKEN_REVOCATIONS_SYNC_INTERVAL)
+        try:
+            await load_token_revocations()
+        except Exception as err:
+            auth_logger.error(f'Token revocations sync failed: "{err}"')
+
+
+def check_superadmin_mutation(current_user) -> None:
     if UserRoles.ROLE_SUPERADMIN in current_user.roles:
         raise HTTPException(status_code=406, detail="Superadmin cannot be deleted via API.")
-    if target_user.user_id != current_user.user_id:
-        # check admin role
-        if not {
-            UserRoles.ROLE_ADMIN,
-            UserRoles.ROLE_SUPERADMIN,
-        }.intersection(current_user.roles):
-            return False
-        # check admin deactivate superadmin attempt
-        if (
-            UserRoles.ROLE_SUPERADMIN in target_user.roles
-            and UserRoles.ROLE_ADMIN in current_user.roles
-        ):
-            return False
-        # check admin deactivate admin attempt
-        if (
-            UserRoles.ROLE_ADMIN in target_user.roles
-            and UserRoles.ROLE_ADMIN in current_user.roles
-        ):
-            return False
-    return True
+
+
+def user_permissions_clause(current_user):
+    """ Права на изменение пользователя в виде SQL условия на целевую строку users.
+
+    Себя может менять любой; админ - ещё и пользователей без ролей админа и суперадмина.
+    id текущего пользователя передаётся параметром current_user_id, поэтому условие
+    (и запрос с ним) одно на набор ролей. Случай суперадмина (406) - check_superadmin_mutation.
+    """
+    return _user_permissions_clause(is_admin=UserRoles.ROLE_ADMIN in current_user.roles)
+
+
+@functools.lru_cache(maxsize=None)
+def _user_permissions_clause(is_admin: bool):
+    own = User.user_id == bindparam("current_user_id")
+    if not is_admin:
+        return own
+    # Админ не может менять других админов и суперадминов
+    return or_(own, ~User.roles.overlap([UserRoles.ROLE_ADMIN.value, UserRoles.ROLE_SUPERADMIN.value]))
 
 
 async def authenticate_user(email: str, password: str, db: AsyncSession) -> Union[User, None]:
     user = await _get_user_by_email_for_auth(email=email, db=db)
     if user is None:
         return None
-    if not Hasher.verify_password(password, user.hashed_password):
+    # Закрываем транзакцию с поиском пользователя: соединение не держится во время bcrypt
+    await db.commit()
+    verified, new_hash = await Hasher.verify_and_update_async(password, user.hashed_password)
+    # Деактивированный пользователь не получает токены; проверка после bcrypt, чтобы
+    # по времени ответа нельзя было отличить неактивную учётную запись от неверного пароля
+    if not verified or not user.is_active:
         return None
+    if new_hash is not None:
+        # Устаревшая схема или другая стоимость bcrypt - пересчитываем без сброса пароля
+        await UserCRUD(db).set_password_hash(user_id=user.user_id, hashed_password=new_hash)
+        user.hashed_password = new_hash
     return user
 
 
 async def _get_user_by_email_for_auth(email: Optional[str] = None,
                                       user_id: Optional[str] = None,
                                       db: AsyncSession = None):
-    async with db.begin():
-        crud = UserCRUD(db)
-        if user_id:
-            return await crud.get_by_id_or_email(user_id=user_id)
-        elif email:
-            return await crud.get_by_id_or_email(user_email=email)
-        return None
+    crud = UserCRUD(db)
+    if user_id:
+        return await crud.get_by_id_or_email(user_id=user_id)
+    elif email:
+        return await crud.get_by_id_or_email(user_email=email)
+    return None
 
 
 async def get_current_user_from_token(token: str = Depends(oauth2_scheme),
-                                      db: AsyncSession = Depends(get_db)):
+                                      db: AsyncSession = Depends(get_db)) -> AuthUser:
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                           detail="Could not validate credentials")
     try:
-        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        payload = decode_access_token(token)
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = await _get_user_by_email_for_auth(user_id=user_id, db=db)
-    if user is None:
+    if JWT_CLAIMS_MODE and "ver" in payload:
+        if token_revocations.is_revoked(user_id, payload["ver"]):
+            raise credentials_exception
+        current_user = AuthUser(user_id=user_id,
+                                is_active=payload["is_active"],
+                                roles=payload["roles"])
+    else:
+        current_user = principal_cache.get(user_id)
+        if current_user is None:
+            user = await _get_user_by_email_for_auth(user_id=user_id, db=db)
+            if user is None:
+                raise credentials_exception
+            # Неактивные тоже кэшируются: повторные запросы с их токеном не идут в БД.
+            # Деактивация сбрасывает запись (UserCRUD), в других воркерах - через PRINCIPAL_CACHE_TTL
+            current_user = AuthUser.from_orm(user)
+            principal_cache.set(user_id, current_user)
+    if not current_user.is_active:
         raise credentials_exception
-    return user
+    return current_user
 
 
-async def get_user_for_auth(user_id_or_email: Union[UUID, EmailStr], db: AsyncSession = None):
-    if isinstance(user_id_or_email, UUID):
-        user = await _get_user_by_email_for_auth(user_id=user_id_or_email, db=db)
-    else:
-        user = await _get_user_by_email_for_auth(email=user_id_or_email, db=db)
-    if user is None:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                            detail="Could not validate credentials")
-    return user
+async def get_current_admin_from_token(current_user: AuthUser = Depends(get_current_user_from_token)) -> AuthUser:
+    if not {
+        UserRoles.ROLE_ADMIN,
+        UserRoles.ROLE_SUPERADMIN,
+    }.intersection(current_user.roles):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    return current_user
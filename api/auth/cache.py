@@ -0,0 +1,60 @@
+from utils.caching import TTLCache
+from settings import (
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    VERIFIED_TOKEN_CACHE_SIZE,
+    PRINCIPAL_CACHE_SIZE,
+    PRINCIPAL_CACHE_TTL,
+    REFRESH_TOKEN_EXPIRE_MINUTES,
+    REFRESH_TOKEN_REGISTRY_SIZE
+)
+
+
+# Аутентифицированные пользователи по user_id. Мутации в UserCRUD сбрасывают запись,
+# в остальных воркерах данные устаревают не дольше чем на PRINCIPAL_CACHE_TTL секунд
+principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
+# Payload проверенных access токенов, чтобы не вызывать jwt.decode на каждый запрос
+verified_tokens = TTLCache(maxsize=VERIFIED_TOKEN_CACHE_SIZE, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+# jti уже использованных refresh токенов (ротация: каждый refresh токен одноразовый).
+# Быстрая проверка в пределах воркера, источник истины - таблица used_refresh_tokens
+used_refresh_tokens = TTLCache(maxsize=REFRESH_TOKEN_REGISTRY_SIZE, ttl=REFRESH_TOKEN_EXPIRE_MINUTES * 60)
+
+
+class TokenRevocations:
+    """ Минимальная допустимая версия токена для каждого пользователя.
+
+    Хранятся только пользователи, у которых версия менялась, и недавно удалённые,
+    поэтому структура компактная. Состояние своё в каждом воркере: мутация отзывает
+    токены сразу только в своём воркере, остальные подтягивают users.token_version > 0
+    и таблицу deleted_users при старте и периодически (sync_token_revocations).
+    """
+    REVOKED_ALL = 2 ** 31
+
+    def __init__(self) -> None:
+        self._min_versions: dict[str, int] = {}
+
+    def revoke(self, user_id, min_version: int) -> None:
+        key = str(user_id)
+        if min_version > self._min_versions.get(key, 0):
+            self._min_versions[key] = min_version
+
+    def revoke_all(self, user_id) -> None:
+        self.revoke(user_id, self.REVOKED_ALL)
+
+    def is_revoked(self, user_id, version: int) -> bool:
+        return version < self._min_versions.get(str(user_id), 0)
+
+    def load(self, rows) -> None:
+        """ Версии только растут, поэтому загрузка объединяется с уже известными отзывами """
+        for user_id, version in rows:
+            self.revoke(user_id, version)
+
+    def clear(self) -> None:
+        self._min_versions.clear()
+
+    def __len__(self) -> int:
+        return len(self._min_versions)
+
+
+token_revocations = TokenRevocations()
@@ -1,21 +1,42 @@
 from uuid import UUID
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
-from api.auth.models import Token
+from api.auth.models import Token, RefreshTokenRequest
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from db.session import get_db
-from api.auth.actions import authenticate_user, create_access_token
+from db.session import get_db, UnitOfWorkRoute
+from api.auth.actions import (
+    login_throttler,
+    authenticate_user,
+    create_user_access_token,
+    create_refresh_token,
+    refresh_tokens
+)
 
 
-auth_router = APIRouter()
+auth_router = APIRouter(route_class=UnitOfWorkRoute)
+
+UNKNOWN_CLIENT = "unknown"
 
 
 @auth_router.post("/get_token", response_model=Token)
-async def get_tokens_handler(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+async def get_tokens_handler(request: Request,
+                             form_data: OAuth2PasswordRequestForm = Depends(),
+                             db: AsyncSession = Depends(get_db)):
+    # До поиска пользователя и bcrypt. Адреса клиента может не быть (например, unix socket) -
+    # тогда такие запросы делят один общий лимит
+    client = request.client.host if request.client is not None else UNKNOWN_CLIENT
+    await login_throttler.check(email=form_data.username, client=client)
     user = await authenticate_user(email=form_data.username, password=form_data.password, db=db)
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email or password")
-    access_token = create_access_token(data={"sub": str(user.user_id), "custom_data": "FHRETEB67EnneE"})
-    return Token(access_token=access_token, refresh_token=access_token, token_type="bearer")
+    access_token = create_user_access_token(user)
+    refresh_token = create_refresh_token(user_id=user.user_id, token_version=user.token_version)
+    return Token(access_token=access_token, refresh_token=refresh_token, token_type="bearer")
+
+
+@auth_router.post("/refresh", response_model=Token)
+async def refresh_tokens_handler(data: RefreshTokenRequest, db: AsyncSession = Depends(get_db)):
+    access_token, refresh_token = await refresh_tokens(refresh_token=data.refresh_token, db=db)
+    return Token(access_token=access_token, refresh_token=refresh_token, token_type="bearer")
@@ -1,8 +1,22 @@
+import uuid
 from pydantic import BaseModel
 from typing import Optional
 
+from api.user.models import DefaultModel
+
 
 class Token(BaseModel):
     access_token: str
     refresh_token: Optional[str] = None
     token_type: str = "bearer"
+
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
+
+
+class AuthUser(DefaultModel):
+    """ Текущий пользователь, восстановленный по токену: только то, что нужно для проверки доступа """
+    user_id: uuid.UUID
+    is_active: bool
+    roles: list[str]
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Depends
+
+from api.auth.actions import get_current_admin_from_token
+from api.auth.cache import principal_cache, verified_tokens
+from api.user.cache import users_count_cache, users_page_cache
+from db.session import get_pool_metrics
+
+
+# Метрики раскрывают внутреннее состояние сервиса, поэтому доступны только администраторам
+metrics_router = APIRouter(dependencies=[Depends(get_current_admin_from_token)])
+
+
+@metrics_router.get("/db_pool")
+async def db_pool_metrics_handler():
+    """ Состояние пула соединений: занятые, свободные, overflow, ожидание и таймауты checkout """
+    return get_pool_metrics()
+
+
+@metrics_router.get("/caches")
+async def caches_metrics_handler():
+    return {"principals": principal_cache.stats(),
+            "verified_tokens": verified_tokens.stats(),
+            "users_count": users_count_cache.stats(),
+            "users_pages": users_page_cache.stats()}
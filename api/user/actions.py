@@ -1,110 +1,397 @@
-from pydantic import EmailStr
-from typing import Union
-from uuid import UUID
+import asyncio
+import base64
+import binascii
+import csv
+import io
+import json
+from fastapi import Depends, HTTPException, status
+from pydantic import EmailStr, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncIterator, Union, Optional
+from uuid import UUID, uuid4
 
 from api.user.models import (
     UserCreate,
     GetUser,
-    UserRoles
+    UserRoles,
+    BulkCreateStatus,
+    BulkCreateItemResult,
+    BulkCreateResponse,
+    BulkMutationResponse,
+    MutationResult
 )
+from api.auth.actions import check_superadmin_mutation, user_permissions_clause
+from api.user.cache import users_count_cache, invalidate_users_pages
 from api.user.exceptions import UserExists
-from db.crud import UserCRUD
+from db.crud import UserCRUD, normalize_email
+from db.session import get_db, read_only
+from utils.dataloader import DataLoader
+from utils.etags import make_etag, parse_etags
 from utils.hashing import Hasher
+from settings import (
+    USERS_EXPORT_BATCH_SIZE,
+    USERS_BULK_INSERT_CHUNK,
+    USERS_BULK_HASH_CONCURRENCY,
+    USERS_EXACT_COUNT_TIMEOUT_MS,
+    USERS_BATCH_LOOKUP_MAX_ITEMS
+)
+
+
+EXPORT_FIELDS = ("user_id", "username", "name", "surname", "email", "is_active", "roles")
+
+
+def user_from_row(row) -> GetUser:
+    """ GetUser из строки с колонками db.crud.USER_VIEW_COLUMNS, без повторной валидации """
+    return GetUser.construct(**row._mapping)
+
+
+def user_dict_from_row(row) -> dict:
+    """ Данные GetUser из строки с колонками db.crud.USER_VIEW_COLUMNS для RowsJSONResponse.
+    Строки из нашей БД уже валидны, поэтому pydantic и jsonable_encoder пропускаются
+    """
+    return dict(row._mapping)
 
 
 async def create_new_user(data: UserCreate, db) -> GetUser:
-    async with db.begin():
-        pwd_hash = Hasher.get_password_hash(plain_password=data.password)
-        user_crud = UserCRUD(db)
+    # Хэшируем до открытия транзакции, чтобы не держать соединение во время bcrypt
+    pwd_hash = await Hasher.get_password_hash_async(plain_password=data.password)
+    user_crud = UserCRUD(db)
+    user = await user_crud.create(username=data.username,
+                                  name=data.name,
+                                  surname=data.surname,
+                                  email=data.email,
+                                  hashed_password=pwd_hash)
+    if user is None:
+        # Дополнительный запрос только при конфликте
+        conflicts = await user_crud.get_conflicting_fields(email=data.email, username=data.username)
+        if conflicts == {"email", "username"}:
+            raise UserExists(msg="Email and username already exist")
+        if conflicts == {"email"}:
+            raise UserExists(msg="Email already exists")
+        if conflicts == {"username"}:
+            raise UserExists(msg="Username already exists")
+        raise UserExists(msg="User exists")
+    invalidate_users_pages(db)
+    return user_from_row(user)
+
+
+async def bulk_create_users(items: list, db) -> BulkCreateResponse:
+    results: list[Optional[BulkCreateItemResult]] = [None] * len(items)
+    valid: list[tuple[int, UserCreate]] = []
+    seen_emails, seen_usernames = set(), set()
+    for index, item in enumerate(items):
         try:
-            user = await user_crud.create(username=data.username,
-                                          name=data.name,
-                                          surname=data.surname,
-                                          email=data.email,
-                                          hashed_password=pwd_hash)
-        except Exception:
-            raise UserExists(msg='User exists or other db error')
-        return GetUser(user_id=user.user_id,
-                       username=user.username,
-                       name=user.name,
-                       surname=user.surname,
-                       email=user.email,
-                       is_active=user.is_active,)
-
-
-async def get_by_id_or_email(user_id_or_email: Union[UUID, EmailStr], db) -> Union[GetUser, None]:
-    async with db.begin():
-        user_crud = UserCRUD(db)
-        if isinstance(user_id_or_email, UUID):
-            user = await user_crud.get_by_id_or_email(user_id=user_id_or_email)
+            user = UserCreate.parse_obj(item)
+        except ValidationError as e:
+            results[index] = BulkCreateItemResult(index=index, status=BulkCreateStatus.INVALID, detail=str(e))
+            continue
+        except HTTPException as e:
+            results[index] = BulkCreateItemResult(index=index, status=BulkCreateStatus.INVALID, detail=e.detail)
+            continue
+        if normalize_email(user.email) in seen_emails or user.username in seen_usernames:
+            results[index] = BulkCreateItemResult(index=index, status=BulkCreateStatus.DUPLICATE,
+                                                  email=user.email, detail="Duplicate in batch")
+            continue
+        seen_emails.add(normalize_email(user.email))
+        seen_usernames.add(user.username)
+        valid.append((index, user))
+
+    # Хэши считаем вне транзакции (проверка токена уже закоммичена). Не больше
+    # USERS_BULK_HASH_CONCURRENCY задач в пуле одновременно, чтобы не отнимать его у логинов
+    await db.commit()
+    semaphore = asyncio.Semaphore(USERS_BULK_HASH_CONCURRENCY)
+
+    async def hash_password(password: str) -> str:
+        async with semaphore:
+            return await Hasher.get_password_hash_async(plain_password=password)
+
+    hashes = await asyncio.gather(*(hash_password(user.password) for _, user in valid), return_exceptions=True)
+    hashed = []
+    for (index, user), pwd_hash in zip(valid, hashes):
+        if isinstance(pwd_hash, Exception):
+            # Ошибка одного элемента не отменяет остальные
+            detail = pwd_hash.detail if isinstance(pwd_hash, HTTPException) else "Password hashing failed"
+            results[index] = BulkCreateItemResult(index=index, status=BulkCreateStatus.FAILED,
+                                                  email=user.email, detail=detail)
         else:
-            user = await user_crud.get_by_id_or_email(user_email=user_id_or_email)
-        if user is None:
-            return None
-        print(f'user_id: {user.user_id}, user_roles: {user.roles}')
-        return GetUser(user_id=user.user_id,
-                       username=user.username,
-                       name=user.name,
-                       surname=user.surname,
-                       email=user.email,
-                       is_active=user.is_active,)
-
-
-async def get_all_users(limit: int, offset: int, db) -> list[GetUser]:
-    async with db.begin():
+            hashed.append(((index, user), pwd_hash))
+    valid = [item for item, _ in hashed]
+    rows = [{"user_id": uuid4(),
+             "username": user.username,
+             "name": user.name,
+             "surname": user.surname,
+             "email": user.email,
+             "hashed_password": pwd_hash,
+             "is_active": True}
+            for (_, user), pwd_hash in hashed]
+
+    inserted = set()
+    if rows:
         user_crud = UserCRUD(db)
-        users = await user_crud.get_all_users(limit=limit, offset=offset)
-        users_list = []
-        for user in users:
-            users_list.append(user["User"])
-        return users_list
+        for start in range(0, len(rows), USERS_BULK_INSERT_CHUNK):
+            inserted |= await user_crud.bulk_create(rows[start:start + USERS_BULK_INSERT_CHUNK])
+        if inserted:
+            invalidate_users_pages(db)
+
+    for (index, user), row in zip(valid, rows):
+        if row["user_id"] in inserted:
+            results[index] = BulkCreateItemResult(index=index, status=BulkCreateStatus.CREATED,
+                                                  email=user.email, user_id=row["user_id"])
+        else:
+            results[index] = BulkCreateItemResult(index=index, status=BulkCreateStatus.DUPLICATE,
+                                                  email=user.email, detail="User exists")
+    return BulkCreateResponse(
+        created=len(inserted),
+        duplicates=sum(item.status == BulkCreateStatus.DUPLICATE for item in results),
+        invalid=sum(item.status == BulkCreateStatus.INVALID for item in results),
+        failed=sum(item.status == BulkCreateStatus.FAILED for item in results),
+        items=results)
+
+
+def _with_etag(user: dict) -> tuple[dict, str]:
+    """ Данные GetUser без version и ETag; user из загрузчика общий для всех ключей и не меняется """
+    user = dict(user)
+    return user, make_etag(user["user_id"], user.pop("version"))
+
+
+async def get_by_id_or_email(user_id_or_email: Union[UUID, EmailStr],
+                             loader: DataLoader) -> Optional[tuple[dict, str]]:
+    """ Возвращает (данные GetUser, ETag). Запрос идёт через загрузчик запроса,
+    поэтому одновременные поиски объединяются в один SELECT
+    """
+    user = await loader.load(user_loader_key(user_id_or_email))
+    if user is None:
+        return None
+    return _with_etag(user)
+
+
+@read_only
+async def _load_users(keys: list[Union[UUID, str]], db) -> dict:
+    user_ids = [key for key in keys if isinstance(key, UUID)]
+    emails = [key for key in keys if not isinstance(key, UUID)]
+    rows = await UserCRUD(db).get_views_by_ids_or_emails(user_ids=user_ids, emails=emails)
+    users = {}
+    for row in rows:
+        user = user_dict_from_row(row)
+        users[row.user_id] = user
+        users[normalize_email(row.email)] = user
+    return users
+
+
+def get_user_loader(db: AsyncSession = Depends(get_db)) -> DataLoader:
+    """ Загрузчик данных GetUser по user_id или email (ключ - user_loader_key) на время запроса.
+    Все load одного прохода event loop выполняются одним запросом
+    """
+    async def batch_load(keys: list) -> dict:
+        return await _load_users(keys, db=db)
+    return DataLoader(batch_load, max_batch_size=USERS_BATCH_LOOKUP_MAX_ITEMS)
+
+
+def user_loader_key(user_id_or_email: Union[UUID, EmailStr]) -> Union[UUID, str]:
+    return user_id_or_email if isinstance(user_id_or_email, UUID) else normalize_email(user_id_or_email)
+
+
+async def batch_get_users(users: list[Union[UUID, EmailStr]], loader: DataLoader) -> list[dict]:
+    """ Результаты в порядке запроса, для ненайденных found = False """
+    found = await loader.load_many([user_loader_key(key) for key in users])
+    return [{"key": str(key), "found": user is not None, "user": _with_etag(user)[0] if user else None}
+            for key, user in zip(users, found)]
+
+
+def encode_cursor(user_id: UUID) -> str:
+    return base64.urlsafe_b64encode(user_id.bytes).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: str) -> UUID:
+    try:
+        return UUID(bytes=base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor")
+
+
+@read_only
+async def get_all_users(limit: int, offset: int, db,
+                        cursor: Optional[str] = None,
+                        is_active: Optional[bool] = None) -> tuple[list[dict], Optional[str]]:
+    """ Возвращает страницу и курсор следующей страницы (None, если страница последняя) """
+    after_user_id = decode_cursor(cursor) if cursor else None
+    user_crud = UserCRUD(db)
+    # Лишняя строка показывает, есть ли следующая страница
+    rows = await user_crud.get_all_users(limit=limit + 1, offset=offset,
+                                         after_user_id=after_user_id, is_active=is_active)
+    users_list = [user_dict_from_row(row) for row in rows[:limit]]
+    next_cursor = encode_cursor(users_list[-1]["user_id"]) if len(rows) > limit else None
+    return users_list, next_cursor
+
+
+@read_only
+async def count_users(db, is_active: Optional[bool] = None, exact: bool = False) -> tuple[int, bool]:
+    """ Возвращает (число пользователей, точное ли оно).
+
+    По умолчанию - оценка по статистике планировщика (кэшируется). Точный COUNT(*)
+    считается по запросу или если статистики ещё нет, но не дольше
+    USERS_EXACT_COUNT_TIMEOUT_MS; при таймауте возвращается оценка. Результат
+    COUNT(*) без статистики тоже кэшируется и дальше отдаётся как оценка
+    """
+    if not exact:
+        estimate = users_count_cache.get(is_active)
+        if estimate is not None:
+            return estimate, False
+    user_crud = UserCRUD(db)
+    estimate = None if exact else await user_crud.estimate_count(is_active=is_active)
+    if estimate is None:
+        total = await user_crud.count(is_active=is_active, timeout_ms=USERS_EXACT_COUNT_TIMEOUT_MS)
+        if total is not None:
+            if not exact:
+                # Иначе при пустой статистике COUNT(*) выполнялся бы на каждый запрос
+                users_count_cache.set(is_active, total)
+            return total, True
+        estimate = await user_crud.estimate_count(is_active=is_active) or 0
+    users_count_cache.set(is_active, estimate)
+    return estimate, False
+
+
+@read_only
+async def search_users(query: str, limit: int, offset: int, db) -> list[dict]:
+    rows = await UserCRUD(db).search(query=query, limit=limit, offset=offset)
+    return [user_dict_from_row(row) for row in rows]
+
+
+async def export_users(export_format: str, db) -> AsyncIterator[str]:
+    """ Построчный экспорт в ndjson или csv, память не зависит от числа пользователей.
+
+    Генератор читает StreamingResponse уже после commit в UnitOfWorkRoute, поэтому
+    серверный курсор работает в новой транзакции, которую сессия начинает сама
+    (autobegin); её закрывает get_db после отправки ответа. Явный db.begin() упал бы,
+    если бы транзакция проверки токена ещё была открыта.
+    """
+    user_crud = UserCRUD(db)
+    result = await user_crud.stream_all_users(batch_size=USERS_EXPORT_BATCH_SIZE)
+    if export_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        yield buffer.getvalue()
+    async for rows in result.partitions():
+        if export_format == "csv":
+            buffer.seek(0)
+            buffer.truncate()
+            for row in rows:
+                writer.writerow((row.user_id, row.username, row.name, row.surname,
+                                 row.email, row.is_active, ",".join(row.roles)))
+            yield buffer.getvalue()
+        else:
+            yield "".join(json.dumps({"user_id": str(row.user_id),
+                                      "username": row.username,
+                                      "name": row.name,
+                                      "surname": row.surname,
+                                      "email": row.email,
+                                      "is_active": row.is_active,
+                                      "roles": row.roles}, ensure_ascii=False) + "\n"
+                          for row in rows)
 
 
 async def update_user(updated_data: dict,
                       user_id: UUID,
-                      db) -> Union[UUID, None]:
+                      db,
+                      if_match: Optional[str] = None) -> Optional[tuple[UUID, str]]:
+    """ Возвращает (user_id, новый ETag) или None, если активный пользователь не найден.
+
+    if_match - заголовок If-Match: изменение применяется, только если версия строки
+    не менялась с момента чтения, иначе 412
+    """
     # Фильтруем все None значения
     updated_data: dict = {key: value for key, value in updated_data.items() if value is not None}
-    async with db.begin():
-        user_crud = UserCRUD(db)
-        updated_user_id = await user_crud.update(user_id=user_id,
-                                                 **updated_data)
-        return updated_user_id
+    expected_versions = None
+    # If-Match сравнивается строго: заголовок только из слабых тегов не совпадает ни с чем
+    tags = parse_etags(if_match)
+    if if_match and "*" not in tags:
+        prefix = make_etag(user_id)[:-1] + "."
+        expected_versions = [int(tag[len(prefix):-1]) for tag in tags
+                             if tag.startswith(prefix) and tag[len(prefix):-1].isdigit()]
+        if not expected_versions:
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="ETag does not match")
+    user_crud = UserCRUD(db)
+    row = await user_crud.update(user_id=user_id, expected_versions=expected_versions, **updated_data)
+    if row is None:
+        if expected_versions is not None:
+            # Дополнительный запрос только при неудаче: 412, если пользователь есть, но уже изменён
+            current = await user_crud.get_view_by_id_or_email(user_id=user_id)
+            if current is not None and current.is_active:
+                raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                                    detail="ETag does not match")
+        return None
+    invalidate_users_pages(db)
+    return row.user_id, make_etag(row.user_id, row.version)
 
 
-async def activate_user(user_id_or_email: Union[UUID, EmailStr], db) -> UUID:
-    async with db.begin():
-        user_crud = UserCRUD(db)
-        if isinstance(user_id_or_email, UUID):
-            user_id = await user_crud.activate(user_id=user_id_or_email)
-        else:
-            user_id = await user_crud.activate(user_email=user_id_or_email)
-        return user_id
+async def mutate_user(action: str,
+                      user_id_or_email: Union[UUID, EmailStr],
+                      current_user,
+                      db) -> tuple[MutationResult, Optional[UUID]]:
+    """ Проверка прав и изменение одним запросом (activate / deactivate / delete) """
+    check_superadmin_mutation(current_user)
+    is_user_id = isinstance(user_id_or_email, UUID)
+    user_crud = UserCRUD(db)
+    rows = await user_crud.mutate_many(action=action,
+                                       user_ids=[user_id_or_email] if is_user_id else [],
+                                       emails=[] if is_user_id else [user_id_or_email],
+                                       allowed=user_permissions_clause(current_user),
+                                       current_user_id=current_user.user_id)
+    if not rows:
+        return MutationResult.NOT_FOUND, None
+    row = rows[0]
+    if not row.allowed:
+        return MutationResult.FORBIDDEN, row.user_id
+    if not row.changed:
+        return MutationResult.UNCHANGED, row.user_id
+    invalidate_users_pages(db)
+    return MutationResult.CHANGED, row.user_id
 
 
-async def deactivate_user(user_id_or_email: Union[UUID, EmailStr], db) -> UUID:
-    async with db.begin():
-        user_crud = UserCRUD(db)
-        if isinstance(user_id_or_email, UUID):
-            user_id = await user_crud.deactivate(user_id=user_id_or_email)
-        else:
-            user_id = await user_crud.deactivate(user_email=user_id_or_email)
-        return user_id
+async def activate_user(user_id_or_email: Union[UUID, EmailStr], current_user, db) -> tuple[MutationResult, Optional[UUID]]:
+    return await mutate_user(action="activate", user_id_or_email=user_id_or_email, current_user=current_user, db=db)
 
 
-async def delete_user(user_id_or_email: Union[UUID, EmailStr], db) -> UUID:
-    async with db.begin():
-        user_crud = UserCRUD(db)
-        if isinstance(user_id_or_email, UUID):
-            user_id = await user_crud.delete(user_id=user_id_or_email)
-        else:
-            user_id = await user_crud.delete(user_email=user_id_or_email)
-        return user_id
+async def deactivate_user(user_id_or_email: Union[UUID, EmailStr], current_user, db) -> tuple[MutationResult, Optional[UUID]]:
+    return await mutate_user(action="deactivate", user_id_or_email=user_id_or_email, current_user=current_user, db=db)
 
 
-async def check_email_exists(email: str, db) -> bool:
-    async with db.begin():
-        user_crud = UserCRUD(db)
-        result = await user_crud.exists_by_email(email=email)
-        exists: bool = result["anon_1"]
-        return exists
+async def delete_user(user_id_or_email: Union[UUID, EmailStr], current_user, db) -> tuple[MutationResult, Optional[UUID]]:
+    return await mutate_user(action="delete", user_id_or_email=user_id_or_email, current_user=current_user, db=db)
+
+
+async def bulk_mutate_users(action: str,
+                            users: list[Union[UUID, EmailStr]],
+                            current_user,
+                            db) -> BulkMutationResponse:
+    """ action: activate / deactivate / delete. Права проверяются для каждой строки в SQL """
+    check_superadmin_mutation(current_user)
+    keys = list(dict.fromkeys(users))
+    user_ids = [key for key in keys if isinstance(key, UUID)]
+    emails = [key for key in keys if not isinstance(key, UUID)]
+    user_crud = UserCRUD(db)
+    rows = await user_crud.mutate_many(action=action,
+                                       user_ids=user_ids,
+                                       emails=emails,
+                                       allowed=user_permissions_clause(current_user),
+                                       current_user_id=current_user.user_id)
+    if any(row.changed for row in rows):
+        invalidate_users_pages(db)
+    rows_by_key = {}
+    for row in rows:
+        rows_by_key[row.user_id] = row
+        rows_by_key[normalize_email(row.email)] = row
+    response = BulkMutationResponse(changed=[], skipped=[], forbidden=[], not_found=[])
+    for key in keys:
+        row = rows_by_key.get(key if isinstance(key, UUID) else normalize_email(key))
+        if row is None:
+            response.not_found.append(str(key))
+        elif not row.allowed:
+            response.forbidden.append(str(key))
+        elif row.changed:
+            if row.user_id not in response.changed:
+                response.changed.append(row.user_id)
+        else:
+            response.skipped.append(str(key))
+    return response
@@ -0,0 +1,31 @@
+from sqlalchemy import event
+
+from utils.caching import TTLCache, ResponseCache
+from settings import (
+    USERS_COUNT_CACHE_TTL,
+    USERS_PAGE_CACHE_SIZE,
+    USERS_PAGE_CACHE_MAX_BYTES,
+    USERS_PAGE_CACHE_TTL
+)
+
+
+# Оценки числа пользователей по значению фильтра is_active (None - без фильтра)
+users_count_cache = TTLCache(maxsize=8, ttl=USERS_COUNT_CACHE_TTL)
+
+# Сериализованные страницы get_all_users: (body, headers) по (generation, параметры запроса)
+users_page_cache = ResponseCache(maxsize=USERS_PAGE_CACHE_SIZE,
+                                 ttl=USERS_PAGE_CACHE_TTL,
+                                 maxbytes=USERS_PAGE_CACHE_MAX_BYTES)
+
+
+def _bump_users_pages(session) -> None:
+    users_page_cache.bump()
+
+
+def invalidate_users_pages(db) -> None:
+    """ Сбрасывает кэш страниц сразу и ещё раз после commit транзакции db:
+    страница, прочитанная параллельным запросом до commit, тоже не попадёт в кэш
+    """
+    users_page_cache.bump()
+    if not event.contains(db.sync_session, "after_commit", _bump_users_pages):
+        event.listen(db.sync_session, "after_commit", _bump_users_pages)
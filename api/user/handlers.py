@@ -1,44 +1,59 @@
 from uuid import UUID
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, Body, Header, HTTPException, Query, Response, status
 from api.user.models import (
     UserCreate,
     GetUser,
     UpdatedUserResponse,
     DeleteUserResponse,
-    UserUpdate
+    UserUpdate,
+    BulkCreateResponse,
+    BulkUsersRequest,
+    BulkMutationResponse,
+    BatchLookupRequest,
+    BatchLookupResponse,
+    MutationResult
 )
 from fastapi import Depends
+from fastapi.responses import StreamingResponse
 from pydantic import EmailStr
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Union, Optional
 
-from db.session import get_db
+from db.session import get_db, UnitOfWorkRoute
+from api.user.cache import users_page_cache
+from utils.dataloader import DataLoader
+from utils.etags import etag_matches
+from utils.responses import RowsJSONResponse
+from settings import USERS_PAGE_MAX_LIMIT, USERS_BULK_CREATE_MAX_ITEMS
 from api.user.actions import (
     create_new_user,
-    check_email_exists,
+    bulk_create_users,
     get_all_users,
+    count_users,
+    export_users,
+    search_users,
     get_by_id_or_email,
+    get_user_loader,
+    batch_get_users,
     update_user,
     activate_user,
     deactivate_user,
-    delete_user
+    delete_user,
+    bulk_mutate_users
 )
 from api.user.exceptions import UserExists
 from api.auth.actions import (
+    optional_oauth2_scheme,
     get_current_user_from_token,
-    get_user_for_auth,
-    check_user_permissions
+    get_current_admin_from_token
 )
 
 
-user_router = APIRouter()
+user_router = APIRouter(route_class=UnitOfWorkRoute)
 
 
 @user_router.post("/create", response_model=GetUser)
 async def create_user_handler(data: UserCreate, db: AsyncSession = Depends(get_db)):
-    exists: bool = await check_email_exists(email=data.email, db=db)
-    if exists:
-        raise UserExists(msg="Email already exists")
     try:
         result = await create_new_user(data=data, db=db)
     except UserExists as e:
@@ -46,49 +61,153 @@ async def create_user_handler(data: UserCreate, db: AsyncSession = Depends(get_d
     return result
 
 
+@user_router.post("/bulk_create", response_model=BulkCreateResponse)
+async def bulk_create_users_handler(items: list[dict] = Body(..., max_items=USERS_BULK_CREATE_MAX_ITEMS),
+                                    current_user = Depends(get_current_admin_from_token),
+                                    db: AsyncSession = Depends(get_db)):
+    """ Элементы валидируются по схеме UserCreate по отдельности, результат - для каждого элемента """
+    return await bulk_create_users(items=items, db=db)
+
+
 @user_router.get("/get_all_users", response_model=list[GetUser])
-async def get_all_users_handler(limit: Optional[int] = 10, offset: Optional[int] = 0,
+async def get_all_users_handler(limit: int = Query(10, ge=1, le=USERS_PAGE_MAX_LIMIT),
+                                offset: int = Query(0, ge=0),
+                                cursor: Optional[str] = None,
+                                is_active: Optional[bool] = None,
+                                exact_count: bool = False,
+                                token: Optional[str] = Depends(optional_oauth2_scheme),
                                 db: AsyncSession = Depends(get_db)):
-    return await get_all_users(limit=limit, offset=offset, db=db)
+    """ Курсор следующей страницы возвращается в заголовке X-Next-Cursor.
+
+    X-Total-Count - число пользователей с учётом is_active: оценка по статистике БД,
+    если X-Total-Count-Estimated: true. exact_count=true запрашивает точное значение
+    (только для администраторов: COUNT(*) по всей таблице)
+    """
+    if cursor and offset:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Use either cursor or offset")
+    if exact_count:
+        if token is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                detail="Not authenticated",
+                                headers={"WWW-Authenticate": "Bearer"})
+        await get_current_admin_from_token(await get_current_user_from_token(token=token, db=db))
+    # Поколение читается до запроса: если страницу успели изменить, она сохранится под старым ключом
+    cache_key = (users_page_cache.generation, limit, offset, cursor, is_active)
+    if not exact_count:
+        cached = users_page_cache.get(cache_key)
+        if cached is not None:
+            body, headers = cached
+            return Response(content=body, media_type=RowsJSONResponse.media_type, headers=headers)
+    users, next_cursor = await get_all_users(limit=limit, offset=offset, cursor=cursor,
+                                             is_active=is_active, db=db)
+    total, is_exact = await count_users(is_active=is_active, exact=exact_count, db=db)
+    headers = {"X-Total-Count": str(total),
+               "X-Total-Count-Estimated": "false" if is_exact else "true"}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    # Строки из БД отдаются без валидации через response_model, он остаётся для OpenAPI
+    response = RowsJSONResponse(users, headers=headers)
+    if not exact_count:
+        users_page_cache.set(cache_key, (response.body, headers))
+    return response
+
+
+@user_router.get("/search", response_model=list[GetUser])
+async def search_users_handler(q: str = Query(..., min_length=3, max_length=255),
+                               limit: int = Query(10, ge=1, le=USERS_PAGE_MAX_LIMIT),
+                               offset: int = Query(0, ge=0),
+                               current_user = Depends(get_current_admin_from_token),
+                               db: AsyncSession = Depends(get_db)):
+    """ Поиск по подстроке и нечёткий поиск по username, name, surname и email.
+    Минимум 3 символа: короче триграммный индекс не работает
+    """
+    return RowsJSONResponse(await search_users(query=q, limit=limit, offset=offset, db=db))
+
+
+@user_router.get("/export")
+async def export_users_handler(export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+                               current_user = Depends(get_current_admin_from_token),
+                               db: AsyncSession = Depends(get_db)):
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    return StreamingResponse(export_users(export_format=export_format, db=db),
+                             media_type=media_type,
+                             headers={"Content-Disposition": f"attachment; filename=users.{export_format}"})
 
 
 @user_router.get("/get_by_id_or_email", response_model=GetUser)
 async def get_user_handler(user_id_or_email: Union[UUID, EmailStr],
+                           if_none_match: Optional[str] = Header(None),
                            current_user = Depends(get_current_user_from_token),
-                           db: AsyncSession = Depends(get_db)):
-    user = await get_by_id_or_email(user_id_or_email=user_id_or_email, db=db)
-    if user is None:
+                           loader: DataLoader = Depends(get_user_loader)):
+    found = await get_by_id_or_email(user_id_or_email=user_id_or_email, loader=loader)
+    if found is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found or not active")
-    return user
+    user, etag = found
+    if etag_matches(if_none_match, etag, weak=True):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return RowsJSONResponse(user, headers={"ETag": etag})
+
+
+@user_router.post("/batch_get", response_model=BatchLookupResponse)
+async def batch_get_users_handler(data: BatchLookupRequest,
+                                  current_user = Depends(get_current_user_from_token),
+                                  loader: DataLoader = Depends(get_user_loader)):
+    """ Поиск списка пользователей по user_id и email одним запросом вместо N вызовов get_by_id_or_email """
+    return RowsJSONResponse({"items": await batch_get_users(users=data.users, loader=loader)})
 
 
 @user_router.get("/me", response_model=GetUser)
-async def get_current_user_handler(current_user = Depends(get_current_user_from_token),
-                                   db: AsyncSession = Depends(get_db)):
-    return current_user
+async def get_current_user_handler(if_none_match: Optional[str] = Header(None),
+                                   current_user = Depends(get_current_user_from_token),
+                                   loader: DataLoader = Depends(get_user_loader)):
+    """ Профиль читается из БД и в режиме JWT_CLAIMS_MODE: без запросов к БД обходится
+    только проверка доступа. Профиль из claims устаревал бы после /user/update на срок
+    жизни токена, а отзыв токенов на каждое изменение профиля ломает refresh, поэтому
+    /me - один SELECT через загрузчик запроса (с репликой, если она задана)
+    """
+    found = await get_by_id_or_email(user_id_or_email=current_user.user_id, loader=loader)
+    if found is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    user, etag = found
+    if etag_matches(if_none_match, etag, weak=True):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return RowsJSONResponse(user, headers={"ETag": etag})
 
 
 @user_router.put("/update", response_model=UpdatedUserResponse)
 async def update_user_data_handler(user_id: UUID,
                                    updated_data: UserUpdate,
+                                   response: Response,
+                                   if_match: Optional[str] = Header(None),
                                    current_user = Depends(get_current_user_from_token),
                                    db: AsyncSession = Depends(get_db)):
-    updated_user_id = await update_user(updated_data=updated_data.dict(), user_id=user_id, db=db)
-    if updated_user_id is None:
+    """ If-Match с ETag из GET защищает от перезаписи чужих изменений (412) """
+    updated = await update_user(updated_data=updated_data.dict(), user_id=user_id, if_match=if_match, db=db)
+    if updated is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found or not active")
+    updated_user_id, etag = updated
+    response.headers["ETag"] = etag
     return UpdatedUserResponse(updated_user_id=updated_user_id, message='User updated')
 
 
+def _raise_for_mutation_result(result: MutationResult, unchanged_detail: str) -> None:
+    if result == MutationResult.NOT_FOUND:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    if result == MutationResult.FORBIDDEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    if result == MutationResult.UNCHANGED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=unchanged_detail)
+
+
 @user_router.patch("/activate", response_model=DeleteUserResponse)
 async def activate_user_handler(user_id_or_email: Union[UUID, EmailStr],
                                 current_user = Depends(get_current_user_from_token),
                                 db: AsyncSession = Depends(get_db)):
-    target_user = await get_user_for_auth(user_id_or_email=user_id_or_email, db=db)
-    if not check_user_permissions(target_user=target_user, current_user=current_user):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-    activated_user_id = await activate_user(user_id_or_email=user_id_or_email, db=db)
-    if activated_user_id is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found or active")
+    result, activated_user_id = await activate_user(user_id_or_email=user_id_or_email,
+                                                    current_user=current_user,
+                                                    db=db)
+    _raise_for_mutation_result(result, unchanged_detail="User not found or active")
     return DeleteUserResponse(user_id=activated_user_id, message="User activated")
 
 
@@ -96,12 +215,10 @@ async def activate_user_handler(user_id_or_email: Union[UUID, EmailStr],
 async def deactivate_user_handler(user_id_or_email: Union[UUID, EmailStr],
                                   current_user = Depends(get_current_user_from_token),
                                   db: AsyncSession = Depends(get_db)):
-    target_user = await get_user_for_auth(user_id_or_email=user_id_or_email, db=db)
-    if not check_user_permissions(target_user=target_user, current_user=current_user):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-    deactivated_user_id = await deactivate_user(user_id_or_email=user_id_or_email, db=db)
-    if deactivated_user_id is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found or not active")
+    result, deactivated_user_id = await deactivate_user(user_id_or_email=user_id_or_email,
+                                                        current_user=current_user,
+                                                        db=db)
+    _raise_for_mutation_result(result, unchanged_detail="User not found or not active")
     return DeleteUserResponse(user_id=deactivated_user_id, message="User deactivated")
 
 
@@ -109,10 +226,29 @@ async def deactivate_user_handler(user_id_or_email: Union[UUID, EmailStr],
 async def delete_user_handler(user_id_or_email: Union[UUID, EmailStr],
                               current_user = Depends(get_current_user_from_token),
                               db: AsyncSession = Depends(get_db)):
-    target_user = await get_user_for_auth(user_id_or_email=user_id_or_email, db=db)
-    if not check_user_permissions(target_user=target_user, current_user=current_user):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-    deleted_user_id = await delete_user(user_id_or_email=user_id_or_email, db=db)
-    if deleted_user_id is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    result, deleted_user_id = await delete_user(user_id_or_email=user_id_or_email,
+                                                current_user=current_user,
+                                                db=db)
+    _raise_for_mutation_result(result, unchanged_detail="User not found")
     return DeleteUserResponse(user_id=deleted_user_id, message="User deleted")
+
+
+@user_router.patch("/bulk_activate", response_model=BulkMutationResponse)
+async def bulk_activate_users_handler(data: BulkUsersRequest,
+                                      current_user = Depends(get_current_user_from_token),
+                                      db: AsyncSession = Depends(get_db)):
+    return await bulk_mutate_users(action="activate", users=data.users, current_user=current_user, db=db)
+
+
+@user_router.patch("/bulk_deactivate", response_model=BulkMutationResponse)
+async def bulk_deactivate_users_handler(data: BulkUsersRequest,
+                                        current_user = Depends(get_current_user_from_token),
+                                        db: AsyncSession = Depends(get_db)):
+    return await bulk_mutate_users(action="deactivate", users=data.users, current_user=current_user, db=db)
+
+
+@user_router.delete("/bulk_delete", response_model=BulkMutationResponse)
+async def bulk_delete_users_handler(data: BulkUsersRequest,
+                                    current_user = Depends(get_current_user_from_token),
+                                    db: AsyncSession = Depends(get_db)):
+    return await bulk_mutate_users(action="delete", users=data.users, current_user=current_user, db=db)
@@ -5,10 +5,13 @@ from fastapi import HTTPException, status
 from pydantic import (
     BaseModel,
     EmailStr,
+    Field,
     validator,
     constr
 )
-from typing import Optional
+from typing import Optional, Union
+
+from settings import USERS_BULK_MUTATION_MAX_ITEMS, USERS_BATCH_LOOKUP_MAX_ITEMS
 
 
 LETTER_MATCH_PATTERN = re.compile(r"^[а-яА-Яa-zA-Z0-9\-]+$")
@@ -97,3 +100,60 @@ class UserUpdate(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+
+
+class BulkCreateStatus(str, Enum):
+    CREATED = "created"
+    DUPLICATE = "duplicate"
+    INVALID = "invalid"
+    # Не удалось посчитать хэш пароля (например, пул перегружен) - можно повторить
+    FAILED = "failed"
+
+
+class BulkCreateItemResult(BaseModel):
+    index: int
+    status: BulkCreateStatus
+    email: Optional[str] = None
+    user_id: Optional[uuid.UUID] = None
+    detail: Optional[str] = None
+
+
+class BulkCreateResponse(BaseModel):
+    created: int
+    duplicates: int
+    invalid: int
+    failed: int = 0
+    items: list[BulkCreateItemResult]
+
+
+class MutationResult(str, Enum):
+    CHANGED = "changed"
+    UNCHANGED = "unchanged"
+    NOT_FOUND = "not_found"
+    FORBIDDEN = "forbidden"
+
+
+class BulkUsersRequest(BaseModel):
+    users: list[Union[uuid.UUID, EmailStr]] = Field(..., min_items=1, max_items=USERS_BULK_MUTATION_MAX_ITEMS)
+
+
+class BulkMutationResponse(BaseModel):
+    changed: list[uuid.UUID]
+    skipped: list[str]
+    forbidden: list[str]
+    not_found: list[str]
+
+
+class BatchLookupRequest(BaseModel):
+    users: list[Union[uuid.UUID, EmailStr]] = Field(..., min_items=1, max_items=USERS_BATCH_LOOKUP_MAX_ITEMS)
+
+
+class BatchLookupItem(BaseModel):
+    key: str
+    found: bool
+    user: Optional[GetUser] = None
+
+
+class BatchLookupResponse(BaseModel):
+    """ Результаты в порядке запроса; для ненайденных found = false и user = null """
+    items: list[BatchLookupItem]
@@ -0,0 +1,90 @@
+""" Построение запроса UserCRUD и вычисление его cache key:
+на каждый вызов против заранее собранного.
+
+Первая часть меряет только то, что SQLAlchemy делает до поиска в compiled cache (конструкция
+select + _generate_cache_key). Вторая - полный session.execute против БД из DATABASE_URL:
+компиляция из кэша, запрос и разбор строк, то есть какую долю вызова занимает экономия.
+
+python -m benchmarks.crud_statement_cache_key
+"""
+import asyncio
+import time
+import timeit
+from uuid import uuid4
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from db.crud import GET_BY_ID, _list_statement
+from db.models import User
+from settings import DATABASE_URL
+
+
+NUMBER = 20000
+EXECUTE_NUMBER = 2000
+
+
+def built_get_by_id(user_id):
+    return select(User).where(User.user_id == user_id)
+
+
+def built_get_all():
+    return select(User).order_by(User.user_id).limit(50).offset(0)
+
+
+def prebuilt_get_all():
+    return _list_statement(keyset=False, filter_active=False)
+
+
+async def execute_time(execute) -> float:
+    for _ in range(100):
+        await execute()
+    start = time.perf_counter()
+    for _ in range(EXECUTE_NUMBER):
+        await execute()
+    return time.perf_counter() - start
+
+
+async def execute_path() -> None:
+    engine = create_async_engine(DATABASE_URL)
+    user_id = uuid4()
+    async with AsyncSession(engine) as session:
+        async def get_by_id_built():
+            (await session.execute(built_get_by_id(user_id))).fetchall()
+
+        async def get_by_id_prebuilt():
+            (await session.execute(GET_BY_ID, {"user_id": user_id})).fetchall()
+
+        async def get_all_built():
+            (await session.execute(built_get_all())).fetchall()
+
+        async def get_all_prebuilt():
+            params = {"limit": 50, "offset": 0, "after_user_id": None, "is_active": None}
+            (await session.execute(prebuilt_get_all(), params)).fetchall()
+
+        for name, execute in (("get_by_id build + execute:     ", get_by_id_built),
+                              ("get_by_id prebuilt execute:    ", get_by_id_prebuilt),
+                              ("get_all build + execute:       ", get_all_built),
+                              ("get_all prebuilt execute:      ", get_all_prebuilt)):
+            elapsed = await execute_time(execute)
+            print(f"{name}{elapsed / EXECUTE_NUMBER * 1e6:8.2f} us/call")
+    await engine.dispose()
+
+
+def main() -> None:
+    user_id = uuid4()
+    built_time = timeit.timeit(lambda: built_get_by_id(user_id)._generate_cache_key(),
+                               number=NUMBER)
+    prebuilt_time = timeit.timeit(lambda: GET_BY_ID._generate_cache_key(), number=NUMBER)
+    list_built_time = timeit.timeit(lambda: built_get_all()._generate_cache_key(), number=NUMBER)
+    list_prebuilt_time = timeit.timeit(lambda: prebuilt_get_all()._generate_cache_key(),
+                                       number=NUMBER)
+    print(f"get_by_id build + cache key:    {built_time / NUMBER * 1e6:8.2f} us/call")
+    print(f"get_by_id prebuilt cache key:  {prebuilt_time / NUMBER * 1e6:8.2f} us/call")
+    print(f"get_all build + cache key:      {list_built_time / NUMBER * 1e6:8.2f} us/call")
+    print(f"get_all prebuilt cache key:    {list_prebuilt_time / NUMBER * 1e6:8.2f} us/call")
+    asyncio.run(execute_path())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+""" Сравнение jwt.decode и кэша проверенных токенов на один запрос.
+
+python -m benchmarks.token_decode
+"""
+import timeit
+
+from jose import jwt
+
+from api.auth.actions import create_access_token, decode_access_token
+from api.auth.cache import verified_tokens
+from settings import JWT_SECRET_KEY, JWT_ALGORITHM
+
+
+NUMBER = 20000
+
+
+def main() -> None:
+    token = create_access_token(data={"sub": "98183338-6315-43ce-87ae-f8a2bf901094"})
+    decode_time = timeit.timeit(lambda: jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM]),
+                                number=NUMBER)
+    verified_tokens.clear()
+    decode_access_token(token)
+    cached_time = timeit.timeit(lambda: decode_access_token(token), number=NUMBER)
+    print(f"jwt.decode:   {decode_time / NUMBER * 1e6:8.2f} us/call")
+    print(f"cached token: {cached_time / NUMBER * 1e6:8.2f} us/call")
+    print(f"speedup:      {decode_time / cached_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+""" Сериализация страницы пользователей: response_model (pydantic + jsonable_encoder + json)
+против RowsJSONResponse (dict из строки БД сразу в orjson).
+
+python -m benchmarks.user_serialization
+"""
+import timeit
+from uuid import uuid4
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from fastapi.utils import create_response_field
+
+from api.user.models import GetUser
+from utils.responses import RowsJSONResponse
+
+
+NUMBER = 2000
+PAGE_SIZE = 100
+
+
+def main() -> None:
+    rows = [{"user_id": uuid4(),
+             "username": f"user{i}",
+             "name": "Name",
+             "surname": "Surname",
+             "email": f"user{i}@example.com",
+             "is_active": True} for i in range(PAGE_SIZE)]
+    users = [GetUser.construct(**row) for row in rows]
+    field = create_response_field(name="Response", type_=list[GetUser])
+
+    def response_model_path() -> bytes:
+        # То же, что делает FastAPI для response_model (fastapi.routing.serialize_response)
+        value, _ = field.validate(users, {}, loc=("response",))
+        return JSONResponse(jsonable_encoder(value)).body
+
+    def rows_path() -> bytes:
+        return RowsJSONResponse(rows).body
+
+    model_time = timeit.timeit(response_model_path, number=NUMBER)
+    rows_time = timeit.timeit(rows_path, number=NUMBER)
+    print(f"response_model:   {model_time / NUMBER * 1e3:8.3f} ms/page of {PAGE_SIZE}")
+    print(f"RowsJSONResponse: {rows_time / NUMBER * 1e3:8.3f} ms/page of {PAGE_SIZE}")
+    print(f"speedup:          {model_time / rows_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
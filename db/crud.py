@@ -1,110 +1,377 @@
+import functools
+import json
+from datetime import datetime, timedelta
 from typing import Union, Optional
-from uuid import UUID
+from uuid import UUID, uuid4
 from pydantic import EmailStr
-from sqlalchemy import and_, update, delete, select, exists
-from sqlalchemy.ext.asyncio import AsyncSession
-from db.models import User
+from sqlalchemy import (
+    and_, or_, update, delete, select, func, any_, text,
+    bindparam, literal, literal_column, true, BigInteger, Integer, Interval, String
+)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects.postgresql import insert, ARRAY, UUID as PG_UUID
+from sqlalchemy.engine import Row
+from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncResult
+from db.models import User, UsedRefreshToken, DeletedUser
+from api.auth.cache import principal_cache, token_revocations
 from api.user.models import UserRoles
 
 
+MUTATION_ACTIONS = ("activate", "deactivate", "delete")
+
+
+def normalize_email(email: str) -> str:
+    """ Вид email для поиска: уникальность и сравнение без учёта регистра """
+    return email.strip().lower()
+
+
+# Только поля ответа GetUser: без hashed_password/roles и без ORM сущностей в identity map
+USER_VIEW_COLUMNS = (User.user_id,
+                     User.username,
+                     User.name,
+                     User.surname,
+                     User.email,
+                     User.is_active)
+
+# Горячие запросы собираются один раз с bindparam: SQLAlchemy запоминает их cache key
+# и берёт готовый SQL из compiled cache, asyncpg переиспользует prepared statement
+CREATE_USER = (insert(User)
+               .values(user_id=bindparam("user_id"),
+                       username=bindparam("username"),
+                       name=bindparam("name"),
+                       surname=bindparam("surname"),
+                       email=bindparam("email"),
+                       roles=bindparam("roles", type_=ARRAY(String)),
+                       hashed_password=bindparam("hashed_password"),
+                       is_active=True)
+               .on_conflict_do_nothing()
+               .returning(*USER_VIEW_COLUMNS))
+GET_BY_ID = select(User).where(User.user_id == bindparam("user_id"))
+# email сравнивается без учёта регистра по индексу users_email_lower_key,
+# параметр email передаётся уже в нижнем регистре (normalize_email)
+GET_BY_EMAIL = select(User).where(func.lower(User.email) == bindparam("email"))
+GET_CONFLICTING_FIELDS = (select(func.lower(User.email) == bindparam("email"),
+                                 User.username == bindparam("username"))
+                          .where(or_(func.lower(User.email) == bindparam("email"),
+                                     User.username == bindparam("username"))))
+GET_VIEW_BY_ID = select(*USER_VIEW_COLUMNS, User.version).where(User.user_id == bindparam("user_id"))
+GET_VIEW_BY_EMAIL = select(*USER_VIEW_COLUMNS, User.version).where(func.lower(User.email) == bindparam("email"))
+
+# Ротация refresh токена одним запросом: jti записывается как использованный и читается
+# пользователь. Повторный jti не вставится (ON CONFLICT DO NOTHING) и строк не будет,
+# параллельный refresh тем же токеном ждёт на уникальном ключе до commit первого
+_CONSUMED_REFRESH_TOKEN = (insert(UsedRefreshToken)
+                           .values(jti=bindparam("jti"), expires_at=bindparam("expires_at"))
+                           .on_conflict_do_nothing()
+                           .returning(UsedRefreshToken.jti)
+                           .cte("consumed"))
+CONSUME_REFRESH_TOKEN = (select(User)
+                         .join(_CONSUMED_REFRESH_TOKEN, true())
+                         .where(User.user_id == bindparam("user_id")))
+PURGE_USED_REFRESH_TOKENS = delete(UsedRefreshToken).where(UsedRefreshToken.expires_at < bindparam("now"))
+
+# Для TokenRevocations: пользователи с отозванными версиями токенов и недавно удалённые
+GET_TOKEN_VERSIONS = (select(User.user_id, User.token_version)
+                      .where(User.token_version > 0)
+                      .union_all(select(DeletedUser.user_id, literal(token_revocations.REVOKED_ALL, BigInteger))
+                                 .where(DeletedUser.deleted_at > func.now() - bindparam("deleted_within",
+                                                                                        type_=Interval))))
+PURGE_DELETED_USERS = delete(DeletedUser).where(DeletedUser.deleted_at < func.now() - bindparam("deleted_before",
+                                                                                                type_=Interval))
+
+GET_VIEWS_BY_IDS_OR_EMAILS = (select(*USER_VIEW_COLUMNS, User.version)
+                              .where(or_(User.user_id == any_(bindparam("user_ids",
+                                                                        type_=ARRAY(PG_UUID(as_uuid=True)))),
+                                         func.lower(User.email) == any_(bindparam("emails",
+                                                                                  type_=ARRAY(String))))))
+
+# Текст для поиска: должен совпадать с выражением индекса users_search_trgm_idx (pg_trgm GIN),
+# поэтому разделители - литералы в SQL, а не параметры
+_SPACE = literal_column("' '", String)
+SEARCH_DOCUMENT = func.lower(User.username + _SPACE + User.name + _SPACE
+                             + func.coalesce(User.surname, literal_column("''", String)) + _SPACE + User.email)
+_SEARCH_QUERY = bindparam("query", type_=String)
+# Подстрока (LIKE) или нечёткое совпадение слова (<% из pg_trgm), оба условия идут по GIN индексу.
+# Выше в выдаче - лучшее совпадение с началом слова (word_similarity)
+SEARCH_USERS = (select(*USER_VIEW_COLUMNS)
+                .where(or_(SEARCH_DOCUMENT.like(bindparam("pattern", type_=String), escape="/"),
+                           _SEARCH_QUERY.op("<%")(SEARCH_DOCUMENT)))
+                .order_by(func.word_similarity(_SEARCH_QUERY, SEARCH_DOCUMENT).desc(), User.user_id)
+                .limit(bindparam("limit", type_=Integer))
+                .offset(bindparam("offset", type_=Integer)))
+COUNT_USERS = select(func.count()).select_from(User)
+COUNT_USERS_BY_STATUS = select(func.count()).where(User.is_active == bindparam("is_active"))
+# reltuples = -1, пока таблицу ни разу не анализировали
+ESTIMATE_USERS = text("SELECT reltuples::bigint FROM pg_class WHERE oid = 'users'::regclass")
+ESTIMATE_USERS_BY_STATUS = text("EXPLAIN (FORMAT JSON) SELECT 1 FROM users WHERE is_active = :is_active")
+QUERY_CANCELED = "57014"
+
+
+@functools.lru_cache(maxsize=None)
+def _list_statement(keyset: bool, filter_active: bool):
+    """ Запрос страницы для UserCRUD.get_all_users, один на комбинацию опций.
+
+    Порядок по user_id; с фильтром по is_active используется индекс (is_active, user_id)
+    """
+    query = select(*USER_VIEW_COLUMNS).order_by(User.user_id).limit(bindparam("limit", type_=Integer))
+    if filter_active:
+        query = query.where(User.is_active == bindparam("is_active"))
+    if keyset:
+        return query.where(User.user_id > bindparam("after_user_id"))
+    return query.offset(bindparam("offset", type_=Integer))
+
+
+@functools.lru_cache(maxsize=None)
+def _mutation_statement(action: str, allowed: ColumnElement):
+    """ Запрос для UserCRUD.mutate_many, один на пару (action, условие прав) """
+    targets = (select(User.user_id, User.email, allowed.label("allowed"))
+               .where(or_(User.user_id == any_(bindparam("user_ids", type_=ARRAY(PG_UUID(as_uuid=True)))),
+                          func.lower(User.email) == any_(bindparam("emails", type_=ARRAY(String)))))
+               .with_for_update()
+               .cte("targets"))
+    if action == "delete":
+        mutation = delete(User)
+    else:
+        mutation = (update(User)
+                    .where(User.is_active == (action == "deactivate"))
+                    .values(is_active=(action == "activate"),
+                            token_version=User.token_version + 1,
+                            version=User.version + 1))
+    changed = (mutation
+               .where(and_(User.user_id == targets.c.user_id, targets.c.allowed))
+               .returning(User.user_id, User.token_version)
+               .cte("changed"))
+    from_clause = targets.outerjoin(changed, changed.c.user_id == targets.c.user_id)
+    if action == "delete":
+        # Отметка об удалении переживает рестарт и видна остальным воркерам (get_token_versions).
+        # CTE подключается join-ом: add_cte для ORM select в SQLAlchemy 1.4 не рендерится
+        tombstones = (insert(DeletedUser)
+                      .from_select(["user_id"], select(changed.c.user_id))
+                      .on_conflict_do_nothing()
+                      .returning(DeletedUser.user_id)
+                      .cte("tombstones"))
+        from_clause = from_clause.outerjoin(tombstones, tombstones.c.user_id == changed.c.user_id)
+    return (select(targets.c.user_id,
+                   targets.c.email,
+                   targets.c.allowed,
+                   changed.c.user_id.isnot(None).label("changed"),
+                   changed.c.token_version)
+            .select_from(from_clause))
+
+
 class UserCRUD:
     def __init__(self, db_session: AsyncSession) -> None:
         self.db_session = db_session
 
+    @staticmethod
+    def _invalidate_principal(user_id: UUID, token_version: Optional[int] = None) -> None:
+        """ Сбрасывает кэш и отзывает токены, выданные до token_version (None - все) """
+        principal_cache.invalidate(str(user_id))
+        if token_version is None:
+            token_revocations.revoke_all(user_id)
+        else:
+            token_revocations.revoke(user_id, token_version)
+
     async def create(self,
                      username: str,
                      name: str,
                      surname: str,
                      email: str,
-                     hashed_password: str) -> User:
-        new_user = User(username=username,
-                        name=name,
-                        surname=surname,
-                        email=email,
-                        roles=[UserRoles.ROLE_USER, ],
-                        hashed_password=hashed_password)
-        self.db_session.add(new_user)
-        await self.db_session.flush()
-        return new_user
+                     hashed_password: str) -> Optional[Row]:
+        """ INSERT ... ON CONFLICT DO NOTHING RETURNING: None, если email или username заняты """
+        res = await self.db_session.execute(CREATE_USER, {"user_id": uuid4(),
+                                                          "username": username,
+                                                          "name": name,
+                                                          "surname": surname,
+                                                          "email": email,
+                                                          "roles": [UserRoles.ROLE_USER, ],
+                                                          "hashed_password": hashed_password})
+        return res.fetchone()
+
+    async def get_conflicting_fields(self, email: str, username: str) -> set[str]:
+        res = await self.db_session.execute(GET_CONFLICTING_FIELDS, {"email": normalize_email(email),
+                                                                     "username": username})
+        conflicts = set()
+        for email_taken, username_taken in res.fetchall():
+            if email_taken:
+                conflicts.add("email")
+            if username_taken:
+                conflicts.add("username")
+        return conflicts
+
+    async def bulk_create(self, users: list[dict]) -> set[UUID]:
+        """ Один многострочный INSERT; строки, нарушающие уникальность, пропускаются """
+        query = (insert(User)
+                 .values([{**user, "roles": [UserRoles.ROLE_USER, ]} for user in users])
+                 .on_conflict_do_nothing()
+                 .returning(User.user_id))
+        res = await self.db_session.execute(query)
+        return {row[0] for row in res.fetchall()}
 
     async def get_by_id_or_email(self, user_id: Optional[UUID] = None,
                                  user_email: Optional[EmailStr] = None) -> Union[User, None]:
         if user_id:
-            query = select(User).where(User.user_id == user_id)
+            res = await self.db_session.execute(GET_BY_ID, {"user_id": user_id})
         elif user_email:
-            query = select(User).where(User.email == user_email)
-        res = await self.db_session.execute(query)
+            res = await self.db_session.execute(GET_BY_EMAIL, {"email": normalize_email(user_email)})
         user_row = res.fetchone()
         if user_row is not None:
             return user_row[0]
 
-    async def get_all_users(self, limit: int, offset: int) -> Union[list[User], None]:
-        query = select(User).limit(limit).offset(offset)
-        res = await self.db_session.execute(query)
-        user_rows = res.fetchall()
-        return user_rows
+    async def get_view_by_id_or_email(self, user_id: Optional[UUID] = None,
+                                      user_email: Optional[EmailStr] = None) -> Union[Row, None]:
+        """ Как get_by_id_or_email, но строка только с колонками USER_VIEW_COLUMNS и version """
+        if user_id:
+            res = await self.db_session.execute(GET_VIEW_BY_ID, {"user_id": user_id})
+        elif user_email:
+            res = await self.db_session.execute(GET_VIEW_BY_EMAIL, {"email": normalize_email(user_email)})
+        return res.fetchone()
+
+    async def get_views_by_ids_or_emails(self, user_ids: list[UUID], emails: list[str]) -> list[Row]:
+        """ Строки USER_VIEW_COLUMNS и version для набора user_id и email одним запросом, порядок не задан """
+        res = await self.db_session.execute(GET_VIEWS_BY_IDS_OR_EMAILS,
+                                            {"user_ids": user_ids,
+                                             "emails": [normalize_email(email) for email in emails]})
+        return res.fetchall()
+
+    async def get_all_users(self, limit: int, offset: int = 0,
+                            after_user_id: Optional[UUID] = None,
+                            is_active: Optional[bool] = None) -> list[Row]:
+        """ Строки с колонками USER_VIEW_COLUMNS, сортировка по первичному ключу;
+        after_user_id - keyset пагинация вместо OFFSET, is_active - фильтр по статусу
+        """
+        query = _list_statement(keyset=after_user_id is not None, filter_active=is_active is not None)
+        res = await self.db_session.execute(query, {"limit": limit,
+                                                    "offset": offset,
+                                                    "after_user_id": after_user_id,
+                                                    "is_active": is_active})
+        return res.fetchall()
+
+    async def search(self, query: str, limit: int, offset: int = 0) -> list[Row]:
+        """ Поиск по username, name, surname и email; строки с колонками USER_VIEW_COLUMNS """
+        query = query.strip().lower()
+        pattern = "%" + query.replace("/", "//").replace("%", "/%").replace("_", "/_") + "%"
+        res = await self.db_session.execute(SEARCH_USERS, {"query": query,
+                                                           "pattern": pattern,
+                                                           "limit": limit,
+                                                           "offset": offset})
+        return res.fetchall()
+
+    async def estimate_count(self, is_active: Optional[bool] = None) -> Optional[int]:
+        """ Число пользователей по статистике планировщика, без чтения таблицы.
+        None, если статистики ещё нет
+        """
+        if is_active is None:
+            res = await self.db_session.execute(ESTIMATE_USERS)
+            estimate = res.scalar()
+            return estimate if estimate >= 0 else None
+        res = await self.db_session.execute(ESTIMATE_USERS_BY_STATUS, {"is_active": is_active})
+        plan = res.scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    async def count(self, is_active: Optional[bool] = None, timeout_ms: Optional[int] = None) -> Optional[int]:
+        """ Точный COUNT(*). None, если запрос не уложился в timeout_ms """
+        # Savepoint всегда откатывается: вместе с ним снимается SET LOCAL statement_timeout,
+        # и остальные запросы транзакции запроса работают без ограничения
+        savepoint = await self.db_session.begin_nested()
+        try:
+            if timeout_ms:
+                await self.db_session.execute(text(f"SET LOCAL statement_timeout = {int(timeout_ms)}"))
+            if is_active is None:
+                res = await self.db_session.execute(COUNT_USERS)
+            else:
+                res = await self.db_session.execute(COUNT_USERS_BY_STATUS, {"is_active": is_active})
+            return res.scalar()
+        except DBAPIError as err:
+            if getattr(err.orig, "sqlstate", None) != QUERY_CANCELED:
+                raise
+            return None
+        finally:
+            await savepoint.rollback()
 
-    async def update(self, user_id: UUID, **kwargs) -> Union[UUID, None]:
+    async def stream_all_users(self, batch_size: int) -> AsyncResult:
+        """ Серверный курсор: строки приходят пачками по batch_size, а не fetchall() """
+        query = (select(User.user_id,
+                        User.username,
+                        User.name,
+                        User.surname,
+                        User.email,
+                        User.is_active,
+                        User.roles)
+                 .order_by(User.user_id)
+                 .execution_options(yield_per=batch_size))
+        return await self.db_session.stream(query)
+
+    async def update(self, user_id: UUID,
+                     expected_versions: Optional[list[int]] = None,
+                     **kwargs) -> Optional[Row]:
+        """ Возвращает (user_id, version) или None, если активный пользователь не найден
+        или его version не из expected_versions (If-Match)
+        """
+        values = dict(kwargs)
+        values["version"] = User.version + 1
+        # Профиль не попадает в токены, поэтому token_version здесь не меняется
         query = (update(User)
                  .where(and_(User.user_id == user_id, User.is_active == True))
-                 .values(kwargs)
-                 .returning(User.user_id))
+                 .values(values)
+                 .returning(User.user_id, User.version))
+        if expected_versions is not None:
+            query = query.where(User.version.in_(expected_versions))
         res = await self.db_session.execute(query)
-        update_user_id_row = res.fetchone()
-        if update_user_id_row is not None:
-            return update_user_id_row[0]
+        row = res.fetchone()
+        if row is not None:
+            principal_cache.invalidate(str(row.user_id))
+            return row
 
-    async def activate(self, user_id: Optional[UUID] = None,
-                       user_email: Optional[EmailStr] = None ) -> Union[UUID, None]:
-        if user_id:
-            query = (update(User)
-                    .where(and_(User.user_id == user_id, User.is_active == False))
-                    .values(is_active=True)
-                    .returning(User.user_id))
-        elif user_email:
-            query = (update(User)
-                    .where(and_(User.email == user_email, User.is_active == False))
-                    .values(is_active=True)
-                    .returning(User.user_id))
-        res = await self.db_session.execute(query)
-        user_id_row = res.fetchone()
-        if user_id_row is not None:
-            return user_id_row[0]
+    async def set_password_hash(self, user_id: UUID, hashed_password: str) -> None:
+        """ Пересчёт хэша не меняет данные пользователя, поэтому version не увеличивается """
+        query = (update(User)
+                 .where(User.user_id == user_id)
+                 .values(hashed_password=hashed_password))
+        await self.db_session.execute(query)
 
-    async def deactivate(self, user_id: Optional[UUID] = None,
-                         user_email: Optional[EmailStr] = None ) -> Union[UUID, None]:
-        if user_id:
-            query = (update(User)
-                    .where(and_(User.user_id == user_id, User.is_active == True))
-                    .values(is_active=False)
-                    .returning(User.user_id))
-        elif user_email:
-            query = (update(User)
-                    .where(and_(User.email == user_email, User.is_active == True))
-                    .values(is_active=False)
-                    .returning(User.user_id))
-        res = await self.db_session.execute(query)
-        user_id_row = res.fetchone()
-        if user_id_row is not None:
-            return user_id_row[0]
+    async def consume_refresh_token(self, user_id: UUID, jti: str, expires_at: datetime) -> Optional[User]:
+        """ Помечает refresh токен использованным. None - токен уже предъявлялся или пользователя нет """
+        res = await self.db_session.execute(CONSUME_REFRESH_TOKEN,
+                                            {"user_id": user_id, "jti": jti, "expires_at": expires_at})
+        return res.scalar_one_or_none()
 
-    async def delete(self, user_id: Optional[UUID] = None,
-                     user_email: Optional[EmailStr] = None ) -> Union[UUID, None]:
-        if user_id:
-            query = (delete(User)
-                    .where(User.user_id == user_id)
-                    .returning(User.user_id))
-        elif user_email:
-            query = (delete(User)
-                    .where(User.email == user_email)
-                    .returning(User.user_id))
-        res = await self.db_session.execute(query)
-        user_id_row = res.fetchone()
-        if user_id_row is not None:
-            return user_id_row[0]
+    async def purge_used_refresh_tokens(self) -> int:
+        res = await self.db_session.execute(PURGE_USED_REFRESH_TOKENS, {"now": datetime.utcnow()})
+        return res.rowcount
 
-    async def exists_by_email(self, email: str) -> bool:
-        query = exists(User).where(User.email == email).select()
-        res = await self.db_session.execute(query)
-        row = res.fetchone()
-        return row
+    async def get_token_versions(self, deleted_within: timedelta) -> list[tuple[UUID, int]]:
+        """ Минимальные версии токенов: изменённые пользователи и удалённые за deleted_within (все токены) """
+        res = await self.db_session.execute(GET_TOKEN_VERSIONS, {"deleted_within": deleted_within})
+        return res.fetchall()
+
+    async def purge_deleted_users(self, deleted_before: timedelta) -> None:
+        """ Отметки старше deleted_before не нужны: выданные до удаления токены уже истекли """
+        await self.db_session.execute(PURGE_DELETED_USERS, {"deleted_before": deleted_before})
+
+    async def mutate_many(self,
+                          action: str,
+                          user_ids: list[UUID],
+                          emails: list[str],
+                          allowed: ColumnElement,
+                          current_user_id: UUID) -> list[Row]:
+        """ activate / deactivate / delete набора пользователей одним запросом.
+
+        allowed - условие прав на целевую строку (с bindparam current_user_id), для
+        кэширования запроса должно быть одним и тем же объектом. Для каждой найденной
+        строки возвращает user_id, email, allowed и changed (изменена ли строка).
+        """
+        if action not in MUTATION_ACTIONS:
+            raise ValueError(f"Unknown action: {action}")
+        res = await self.db_session.execute(_mutation_statement(action, allowed),
+                                            {"user_ids": user_ids,
+                                             "emails": [normalize_email(email) for email in emails],
+                                             "current_user_id": current_user_id})
+        rows = res.fetchall()
+        for row in rows:
+            if row.changed:
+                self._invalidate_principal(row.user_id, None if action == "delete" else row.token_version)
+        return rows
@@ -1,16 +1,38 @@
 --psql -h localhost -p 5433 -U postgres -d postgres -f db/ddl.sql
 CREATE EXTENSION if not exists "uuid-ossp";
+CREATE EXTENSION if not exists pg_trgm;
 
 
 DROP TABLE IF EXISTS users;
+DROP TABLE IF EXISTS used_refresh_tokens;
+DROP TABLE IF EXISTS deleted_users;
 
 CREATE TABLE IF NOT EXISTS users (
 user_id UUID PRIMARY KEY DEFAULT public.uuid_generate_v4(),
 username VARCHAR(255) UNIQUE NOT NULL,
 name VARCHAR(255) NOT NULL,
 surname VARCHAR(255) NOT NULL,
-email VARCHAR(255) UNIQUE NOT NULL,
-hashed_password VARCHAR(255) UNIQUE NOT NULL,
+email VARCHAR(255) NOT NULL,
+hashed_password VARCHAR(255) NOT NULL,
 roles VARCHAR(50) ARRAY NOT NULL DEFAULT '{ROLE_USER}',
-is_active BOOLEAN DEFAULT false
-);
\ No newline at end of file
+is_active BOOLEAN DEFAULT false,
+token_version INTEGER NOT NULL DEFAULT 0,
+version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS users_email_lower_key ON users (lower(email));
+CREATE INDEX IF NOT EXISTS users_is_active_user_id_idx ON users (is_active, user_id);
+CREATE INDEX IF NOT EXISTS users_search_trgm_idx ON users
+USING gin (lower(username || ' ' || name || ' ' || coalesce(surname, '') || ' ' || email) gin_trgm_ops);
+
+CREATE TABLE IF NOT EXISTS used_refresh_tokens (
+jti VARCHAR(32) PRIMARY KEY,
+expires_at TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_used_refresh_tokens_expires_at ON used_refresh_tokens (expires_at);
+
+CREATE TABLE IF NOT EXISTS deleted_users (
+user_id UUID PRIMARY KEY,
+deleted_at TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ix_deleted_users_deleted_at ON deleted_users (deleted_at);
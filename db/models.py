@@ -1,5 +1,5 @@
 from uuid import uuid4
-from sqlalchemy import Column, String, Boolean
+from sqlalchemy import Column, String, Boolean, Integer, DateTime, Index, func
 from sqlalchemy.dialects.postgresql import UUID, ARRAY
 from db.session import Base
 
@@ -8,10 +8,38 @@ class User(Base):
     __tablename__ = "users"
 
     user_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
-    username = Column(String, nullable=False)
+    username = Column(String, nullable=False, unique=True)
     name = Column(String, nullable=False)
     surname = Column(String, nullable=True)
-    email = Column(String, nullable=False, unique=True)
+    email = Column(String, nullable=False)
     hashed_password = Column(String, nullable=False)
     roles = Column(ARRAY(String), nullable=False)
     is_active = Column(Boolean(), default=True)
+    token_version = Column(Integer, nullable=False, default=0, server_default='0')
+    # Версия строки для ETag / If-Match, увеличивается UserCRUD при каждом изменении данных
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        # email уникален без учёта регистра, поиск идёт по lower(email)
+        Index("users_email_lower_key", func.lower(email), unique=True),
+        # Список пользователей с фильтром по is_active в порядке user_id
+        Index("users_is_active_user_id_idx", is_active, user_id),
+    )
+
+
+class UsedRefreshToken(Base):
+    """ jti уже использованных refresh токенов: повторное предъявление отклоняется во всех воркерах """
+    __tablename__ = "used_refresh_tokens"
+
+    jti = Column(String(32), primary_key=True)
+    # После exp токен не пройдёт проверку подписи, строку можно удалить
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class DeletedUser(Base):
+    """ Удалённые пользователи: их access токены отзываются во всех воркерах, в том числе после рестарта """
+    __tablename__ = "deleted_users"
+
+    user_id = Column(UUID(as_uuid=True), primary_key=True)
+    # Запись нужна, пока живут выданные до удаления access токены (ACCESS_TOKEN_EXPIRE_MINUTES)
+    deleted_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
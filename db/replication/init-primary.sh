@@ -0,0 +1,8 @@
+#!/bin/sh
+# Подготовка primary к streaming репликации (выполняется один раз при инициализации БД)
+set -e
+
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
+    CREATE ROLE replicator WITH REPLICATION LOGIN PASSWORD '$REPLICATION_PASSWORD';
+EOSQL
+echo "host replication replicator all md5" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,13 @@
+#!/bin/sh
+# Hot standby: при первом запуске копирует primary через pg_basebackup (-R пишет
+# primary_conninfo и standby.signal), дальше применяет WAL и отдаёт read-only запросы
+set -e
+
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    until pg_isready -h "$PRIMARY_HOST" -p 5432; do
+        sleep 1
+    done
+    pg_basebackup -h "$PRIMARY_HOST" -U replicator -D "$PGDATA" -R -X stream
+    chmod 0700 "$PGDATA"
+fi
+exec postgres -c hot_standby=on
@@ -1,19 +1,225 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from typing import Generator
+import asyncio
+import functools
+import time
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from sqlalchemy import exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.selectable import CTE
+from typing import Callable, Coroutine, Generator, Optional
 
-from settings import DATABASE_URL
+from settings import (
+    DATABASE_URL,
+    DB_ECHO,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING,
+    DB_STATEMENT_CACHE_SIZE,
+    DB_COMMAND_TIMEOUT,
+    READ_REPLICA_DATABASE_URL,
+    READ_REPLICA_RETRY_SECONDS
+)
 
 
 Base = declarative_base()
 
-engine = create_async_engine(DATABASE_URL, future=True, echo=True)
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """ Пул, который считает ожидание свободного соединения и таймауты checkout """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
 
-async def get_db() -> Generator:
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.checkouts += 1
+            self.wait_seconds_total += elapsed
+            self.wait_seconds_max = max(self.wait_seconds_max, elapsed)
+
+    def metrics(self) -> dict:
+        return {"pool_size": self.size(),
+                "checked_out": self.checkedout(),
+                "idle": self.checkedin(),
+                "overflow": max(self.overflow(), 0),
+                "max_overflow": self._max_overflow,
+                "checkouts": self.checkouts,
+                "checkout_timeouts": self.checkout_timeouts,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_avg": self.wait_seconds_total / self.checkouts if self.checkouts else 0.0,
+                "wait_seconds_max": self.wait_seconds_max}
+
+
+class ReplicaStatus:
+    """ После ошибки соединения реплика не используется retry_seconds секунд """
+    def __init__(self, retry_seconds: float) -> None:
+        self.retry_seconds = retry_seconds
+        self._down_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+    def mark_down(self) -> None:
+        self._down_until = time.monotonic() + self.retry_seconds
+
+
+replica_status = ReplicaStatus(retry_seconds=READ_REPLICA_RETRY_SECONDS)
+
+
+@functools.lru_cache(maxsize=1024)
+def _writes_in_cte(clause) -> bool:
+    """ SELECT с INSERT/UPDATE/DELETE в WITH (например, UserCRUD.mutate_many) - тоже запись.
+
+    Запросы в crud собраны заранее, поэтому обход дерева кэшируется по объекту запроса
+    """
+    return any(isinstance(element, CTE) and isinstance(element.element, UpdateBase)
+               for element in visitors.iterate(clause))
+
+
+class RoutingSession(Session):
+    """ Запросы внутри read_only action идут на реплику, остальные - на primary (bind).
+
+    После первой записи сессия до конца живёт на primary (read-your-writes).
+    """
+    def __init__(self, *args, replica_bind: Optional[Engine] = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.replica_bind = replica_bind
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase) or (clause is not None and _writes_in_cte(clause)):
+            self.info["wrote"] = True
+        if (self.replica_bind is not None
+                and self.info.get("read_only")
+                and not self.info.get("wrote")
+                and replica_status.available):
+            return self.replica_bind
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+def create_engine(url: str) -> AsyncEngine:
+    return create_async_engine(url,
+                               future=True,
+                               echo=DB_ECHO,
+                               poolclass=InstrumentedQueuePool,
+                               pool_size=DB_POOL_SIZE,
+                               max_overflow=DB_MAX_OVERFLOW,
+                               pool_timeout=DB_POOL_TIMEOUT,
+                               pool_recycle=DB_POOL_RECYCLE,
+                               pool_pre_ping=DB_POOL_PRE_PING,
+                               connect_args={"statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+                                             "command_timeout": DB_COMMAND_TIMEOUT})
+
+
+def create_sessionmaker(primary: AsyncEngine, replica: Optional[AsyncEngine] = None) -> sessionmaker:
+    return sessionmaker(primary,
+                        expire_on_commit=False,
+                        class_=AsyncSession,
+                        sync_session_class=RoutingSession,
+                        replica_bind=replica.sync_engine if replica is not None else None)
+
+
+engine = create_engine(DATABASE_URL)
+read_engine = create_engine(READ_REPLICA_DATABASE_URL) if READ_REPLICA_DATABASE_URL else None
+async_session = create_sessionmaker(engine, read_engine)
+
+
+def _is_connection_error(err: Exception) -> bool:
+    if isinstance(err, (OSError, asyncio.TimeoutError, exc.TimeoutError)):
+        return True
+    return isinstance(err, exc.DBAPIError) and err.connection_invalidated
+
+
+def _has_writes(db: AsyncSession) -> bool:
+    sync_session = db.sync_session
+    return bool(db.info.get("wrote") or sync_session.new or sync_session.dirty or sync_session.deleted)
+
+
+def read_only(func):
+    """ Выполняет action (с аргументом db) на реплике.
+
+    Если соединиться с репликой не удалось, она помечается недоступной,
+    а action повторяется на primary. Для этого транзакция сессии откатывается,
+    поэтому при записях в ней (или несохранённых ORM изменениях) ошибка
+    пробрасывается как есть, а не теряет их.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, db, **kwargs):
+        if db.info.get("read_only") or db.info.get("wrote"):
+            return await func(*args, db=db, **kwargs)
+        db.info["read_only"] = True
+        try:
+            return await func(*args, db=db, **kwargs)
+        except Exception as err:
+            if (not _is_connection_error(err)
+                    or getattr(db.sync_session, "replica_bind", None) is None
+                    or _has_writes(db)):
+                raise
+            replica_status.mark_down()
+            await db.rollback()
+            db.info["read_only"] = False
+            return await func(*args, db=db, **kwargs)
+        finally:
+            db.info["read_only"] = False
+    return wrapper
+
+
+def get_pool_metrics() -> dict:
+    metrics = {"primary": engine.sync_engine.pool.metrics()}
+    if read_engine is not None:
+        metrics["replica"] = read_engine.sync_engine.pool.metrics()
+        metrics["replica"]["available"] = replica_status.available
+    return metrics
+
+
+async def get_db(request: Request) -> Generator:
+    """ Одна сессия на запрос: соединение берётся при первом запросе к БД,
+    commit / rollback делает UnitOfWorkRoute после обработчика
+    """
     try:
         session: AsyncSession = async_session()
+        request.state.db = session
         yield session
     finally:
         await session.close()
+
+
+class UnitOfWorkRoute(APIRoute):
+    """ Зависимости (проверка токена) и обработчик работают в одной транзакции сессии get_db.
+
+    Она коммитится один раз после обработчика, до отправки ответа, поэтому ошибка
+    commit возвращается клиенту; при исключении транзакция откатывается.
+    """
+    def get_route_handler(self) -> Callable[[Request], Coroutine[None, None, Response]]:
+        route_handler = super().get_route_handler()
+
+        async def unit_of_work_handler(request: Request) -> Response:
+            try:
+                response = await route_handler(request)
+            except BaseException:
+                session = getattr(request.state, "db", None)
+                if session is not None:
+                    await session.rollback()
+                raise
+            session = getattr(request.state, "db", None)
+            if session is not None:
+                await session.commit()
+            return response
+
+        return unit_of_work_handler
@@ -1,9 +1,13 @@
+import asyncio
 import uvicorn
 from fastapi import FastAPI, status, APIRouter
 from api.user.handlers import user_router
 from api.auth.handlers import auth_router
+from api.auth.actions import load_token_revocations, purge_used_refresh_tokens, sync_token_revocations
+from api.metrics.handlers import metrics_router
 from utils.custom_middlewares import catch_exceptions_middleware
-from settings import DOCS_URL, REDOC_URL
+from utils.hashing import hashing_pool
+from settings import DOCS_URL, REDOC_URL, JWT_CLAIMS_MODE, METRICS_ENABLED
 
 
 app = FastAPI(title="Ceramica API",
@@ -15,6 +19,8 @@ app = FastAPI(title="Ceramica API",
 router = APIRouter()
 router.include_router(user_router, prefix="/user", tags=["user"])
 router.include_router(auth_router, prefix="/auth", tags=["auth"])
+if METRICS_ENABLED:
+    router.include_router(metrics_router, prefix="/metrics", tags=["metrics"])
 
 
 @app.get("/")
@@ -22,6 +28,31 @@ def root():
     return status.HTTP_200_OK
 
 
+@app.on_event("startup")
+async def startup_token_revocations():
+    if JWT_CLAIMS_MODE:
+        await load_token_revocations()
+        app.state.token_revocations_sync = asyncio.create_task(sync_token_revocations())
+
+
+@app.on_event("startup")
+async def startup_used_refresh_tokens_purge():
+    app.state.used_refresh_tokens_purge = asyncio.create_task(purge_used_refresh_tokens())
+
+
+@app.on_event("shutdown")
+def shutdown_background_tasks():
+    for name in ("token_revocations_sync", "used_refresh_tokens_purge"):
+        task = getattr(app.state, name, None)
+        if task is not None:
+            task.cancel()
+
+
+@app.on_event("shutdown")
+def shutdown_hashing_pool():
+    hashing_pool.shutdown()
+
+
 # Кастомные middlewares
 app.middleware('http')(catch_exceptions_middleware)
 app.include_router(router)
@@ -0,0 +1,24 @@
+"""add token_version
+
+Revision ID: 3b8e2f6d1c47
+Revises: 9570c81a1797
+Create Date: 2026-10-18 11:02:14.215731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8e2f6d1c47'
+down_revision = '9570c81a1797'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('token_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'token_version')
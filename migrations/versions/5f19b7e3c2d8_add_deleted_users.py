@@ -0,0 +1,30 @@
+"""add deleted users
+
+Revision ID: 5f19b7e3c2d8
+Revises: a8c6d2f41e07
+Create Date: 2026-10-18 22:14:03.651904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5f19b7e3c2d8'
+down_revision = 'a8c6d2f41e07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('deleted_users',
+                    sa.Column('user_id', postgresql.UUID(as_uuid=True), nullable=False),
+                    sa.Column('deleted_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+                    sa.PrimaryKeyConstraint('user_id'))
+    op.create_index(op.f('ix_deleted_users_deleted_at'), 'deleted_users', ['deleted_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_deleted_users_deleted_at'), table_name='deleted_users')
+    op.drop_table('deleted_users')
@@ -0,0 +1,84 @@
+"""add user lookup indexes
+
+Revision ID: 7d2a9c4e5b18
+Revises: b2e47c90d5f3
+Create Date: 2026-10-18 14:27:51.604318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2a9c4e5b18'
+down_revision = 'b2e47c90d5f3'
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    'users_email_lower_key': "CREATE UNIQUE INDEX CONCURRENTLY users_email_lower_key ON users (lower(email))",
+    'users_is_active_user_id_idx': "CREATE INDEX CONCURRENTLY users_is_active_user_id_idx ON users (is_active, user_id)",
+}
+# Уникальность email без учёта регистра заменяет users_email_key,
+# а уникальность хэша пароля не нужна и стоит лишнего индекса на каждую вставку
+CONSTRAINTS = {
+    'users_email_key': "ALTER TABLE users ADD CONSTRAINT users_email_key UNIQUE (email)",
+    'users_hashed_password_key': "ALTER TABLE users ADD CONSTRAINT users_hashed_password_key UNIQUE (hashed_password)",
+}
+# Что именно сделал upgrade, хранится в комментариях индексов, чтобы downgrade откатил
+# ровно это и не трогал схему, созданную из db/ddl.sql. Комментарий пишется вместе
+# с индексом вне транзакции: он переживает откат остальной части upgrade
+MARKER = '7d2a9c4e5b18'
+
+
+def _comment(conn, name):
+    comment = conn.execute(sa.text(
+        "SELECT obj_description(to_regclass(:name), 'pg_class')"
+    ), {"name": name}).scalar()
+    if not comment or comment.split()[0] != MARKER:
+        return set(), []
+    words = comment.split()[1:]
+    dropped = [w[len('dropped='):] for w in words if w.startswith('dropped=')]
+    return set(words), (dropped[0].split(',') if dropped else [])
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    # CONCURRENTLY не блокирует запись в users, но не работает внутри транзакции.
+    # Невалидный индекс остаётся после прерванной сборки - пересоздаём его
+    with op.get_context().autocommit_block():
+        for name, ddl in INDEXES.items():
+            valid = conn.execute(sa.text(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"
+            ), {"name": name}).scalar()
+            if valid:
+                continue
+            if valid is False:
+                op.execute(f"DROP INDEX CONCURRENTLY {name}")
+            op.execute(ddl)
+            op.execute(f"COMMENT ON INDEX {name} IS '{MARKER} created'")
+    existing = set(conn.execute(sa.text(
+        "SELECT conname FROM pg_constraint WHERE conrelid = 'users'::regclass"
+    )).scalars())
+    dropped = [name for name in CONSTRAINTS if name in existing]
+    if not dropped:
+        return
+    for name in dropped:
+        op.execute(f"ALTER TABLE users DROP CONSTRAINT {name}")
+    words, _ = _comment(conn, 'users_email_lower_key')
+    created = ' created' if 'created' in words else ''
+    op.execute(f"COMMENT ON INDEX users_email_lower_key IS "
+               f"'{MARKER}{created} dropped={','.join(dropped)}'")
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    _, dropped = _comment(conn, 'users_email_lower_key')
+    for name in dropped:
+        op.execute(CONSTRAINTS[name])
+    created = [name for name in INDEXES if 'created' in _comment(conn, name)[0]]
+    if dropped and 'users_email_lower_key' not in created:
+        op.execute("COMMENT ON INDEX users_email_lower_key IS NULL")
+    with op.get_context().autocommit_block():
+        for name in created:
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
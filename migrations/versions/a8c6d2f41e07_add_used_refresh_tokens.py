@@ -0,0 +1,29 @@
+"""add used refresh tokens
+
+Revision ID: a8c6d2f41e07
+Revises: e5b0d93f72a1
+Create Date: 2026-10-18 21:05:37.418260
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8c6d2f41e07'
+down_revision = 'e5b0d93f72a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('used_refresh_tokens',
+                    sa.Column('jti', sa.String(length=32), nullable=False),
+                    sa.Column('expires_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('jti'))
+    op.create_index(op.f('ix_used_refresh_tokens_expires_at'), 'used_refresh_tokens', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_used_refresh_tokens_expires_at'), table_name='used_refresh_tokens')
+    op.drop_table('used_refresh_tokens')
@@ -0,0 +1,48 @@
+"""add username unique index
+
+Revision ID: b2e47c90d5f3
+Revises: 3b8e2f6d1c47
+Create Date: 2026-10-18 13:12:40.873115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2e47c90d5f3'
+down_revision = '3b8e2f6d1c47'
+branch_labels = None
+depends_on = None
+
+# Метка в комментарии индекса: downgrade удаляет только индекс, созданный этой миграцией
+MARKER = 'created by b2e47c90d5f3'
+
+
+def upgrade() -> None:
+    # INSERT ... ON CONFLICT DO NOTHING при создании пользователя опирается на уникальность username.
+    # В схеме из db/ddl.sql это уже ограничение users_username_key - тогда миграция ничего не делает
+    conn = op.get_bind()
+    valid = conn.execute(sa.text(
+        "SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass('users_username_key')"
+    )).scalar()
+    if valid:
+        return
+    # CONCURRENTLY не блокирует запись в users, но не работает внутри транзакции.
+    # Невалидный индекс остаётся после прерванной сборки - пересоздаём его
+    with op.get_context().autocommit_block():
+        if valid is False:
+            op.execute("DROP INDEX CONCURRENTLY users_username_key")
+        op.execute("CREATE UNIQUE INDEX CONCURRENTLY users_username_key ON users (username)")
+        op.execute(f"COMMENT ON INDEX users_username_key IS '{MARKER}'")
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    comment = conn.execute(sa.text(
+        "SELECT obj_description(to_regclass('users_username_key'), 'pg_class')"
+    )).scalar()
+    if comment != MARKER:
+        return
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY users_username_key")
@@ -0,0 +1,27 @@
+"""add user search index
+
+Revision ID: c41f7e08a9d3
+Revises: 7d2a9c4e5b18
+Create Date: 2026-10-18 16:05:33.918204
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41f7e08a9d3'
+down_revision = '7d2a9c4e5b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # Выражение должно совпадать с db.crud.SEARCH_DOCUMENT, иначе планировщик не использует индекс
+    op.execute("CREATE INDEX IF NOT EXISTS users_search_trgm_idx ON users "
+               "USING gin (lower(username || ' ' || name || ' ' || coalesce(surname, '') || ' ' || email) "
+               "gin_trgm_ops)")
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS users_search_trgm_idx")
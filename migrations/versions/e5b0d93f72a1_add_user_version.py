@@ -0,0 +1,24 @@
+"""add user version
+
+Revision ID: e5b0d93f72a1
+Revises: c41f7e08a9d3
+Create Date: 2026-10-18 18:40:12.057219
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b0d93f72a1'
+down_revision = 'c41f7e08a9d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'version')
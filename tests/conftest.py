@@ -8,6 +8,7 @@ import inspect
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import sessionmaker
+from fastapi import Request
 from starlette.testclient import TestClient
 from typing import Any, Generator, Optional
 from uuid import UUID
@@ -18,12 +19,14 @@ sys.path.insert(0, parentdir)
 
 from settings import TEST_DATABASE_URL
 from db.session import get_db
-from api.auth.actions import create_access_token
+from api.auth.actions import create_access_token, login_throttler
+from api.auth.cache import principal_cache, token_revocations, used_refresh_tokens, verified_tokens
+from api.user.cache import users_count_cache, users_page_cache
 from api.user.models import UserRoles
 from main import app
 
 
-CLEAN_TABLES = ["users",]
+CLEAN_TABLES = ["users", "used_refresh_tokens", "deleted_users"]
 
 
 @pytest.fixture(scope="session")
@@ -54,17 +57,27 @@ async def clean_tables(async_session_test):
         async with session.begin():
             for table_for_cleaning in CLEAN_TABLES:
                 await session.execute(f"""TRUNCATE TABLE {table_for_cleaning};""")
+    principal_cache.clear()
+    token_revocations.clear()
+    used_refresh_tokens.clear()
+    verified_tokens.clear()
+    login_throttler.storage.clear()
+    users_count_cache.clear()
+    users_page_cache.clear()
 
 
-async def _get_test_db():
+async def _get_test_db(request: Request):
     try:
         # create async engine for interaction with database
         test_engine = create_async_engine(TEST_DATABASE_URL, future=True, echo=True)
         # create session for the interaction with database
         test_async_session = sessionmaker(test_engine, expire_on_commit=False, class_=AsyncSession)
-        yield test_async_session()
+        session = test_async_session()
+        # commit / rollback делает UnitOfWorkRoute
+        request.state.db = session
+        yield session
     finally:
-        pass
+        await session.close()
 
 
 @pytest_asyncio.fixture(scope="function")
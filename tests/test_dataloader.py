@@ -0,0 +1,55 @@
+import asyncio
+import pytest
+
+from utils.dataloader import DataLoader
+
+
+async def test_loads_in_same_tick_are_coalesced():
+    calls = []
+
+    async def batch_load(keys):
+        calls.append(keys)
+        return {key: key * 2 for key in keys if key != 3}
+
+    loader = DataLoader(batch_load)
+    results = await asyncio.gather(loader.load(1), loader.load(2), loader.load(1), loader.load(3))
+    assert results == [2, 4, 2, None]
+    assert calls == [[1, 2, 3]]
+
+    assert await loader.load_many([4, 5]) == [8, 10]
+    assert calls[-1] == [4, 5]
+    assert loader.batches == 2
+
+
+async def test_batches_are_split_and_errors_propagate():
+    calls = []
+
+    async def batch_load(keys):
+        calls.append(keys)
+        if 0 in keys:
+            raise ValueError("boom")
+        return {key: key for key in keys}
+
+    loader = DataLoader(batch_load, max_batch_size=2)
+    assert await loader.load_many([1, 2, 3]) == [1, 2, 3]
+    assert calls == [[1, 2], [3]]
+    with pytest.raises(ValueError):
+        await loader.load(0)
+
+
+async def test_cancelling_one_caller_keeps_others():
+    release = asyncio.Event()
+
+    async def batch_load(keys):
+        await release.wait()
+        return {key: key for key in keys}
+
+    loader = DataLoader(batch_load)
+    first = asyncio.ensure_future(loader.load(1))
+    second = asyncio.ensure_future(loader.load(1))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    assert await second == 1
+    assert first.cancelled()
@@ -1,6 +1,17 @@
+import asyncio
+import hashlib
 import json
+import pytest
+from fastapi import HTTPException
+from datetime import timedelta
 from uuid import uuid4
 
+from api.auth import actions
+from api.auth.actions import create_access_token, decode_access_token
+from api.auth.cache import principal_cache, token_revocations, used_refresh_tokens
+from api.user.actions import get_by_id_or_email, get_user_loader
+from api.user.cache import users_page_cache
+from db.crud import UserCRUD
 from utils.hashing import Hasher
 from conftest import create_test_auth_headers_for_user
 
@@ -41,6 +52,20 @@ async def test_create_user(client, get_user_from_database):
     
     # test failed
 
+    resp = client.post("/user/create", content=json.dumps(user_data))
+    assert resp.status_code == 409
+    assert resp.json()["detail"] == "Email and username already exist"
+    resp = client.post("/user/create", content=json.dumps({**user_data, "username": "other2000te"}))
+    assert resp.status_code == 409
+    assert resp.json()["detail"] == "Email already exists"
+    resp = client.post("/user/create", content=json.dumps({**user_data, "email": "other@domainte.kz"}))
+    assert resp.status_code == 409
+    assert resp.json()["detail"] == "Username already exists"
+    resp = client.post("/user/create", content=json.dumps({**user_data, "username": "other2000te",
+                                                           "email": user_data["email"].upper()}))
+    assert resp.status_code == 409
+    assert resp.json()["detail"] == "Email already exists"
+
     user_data['username'] = '!@3'
     resp = client.post("/user/create", content=json.dumps(user_data))
     data_from_resp = resp.json()
@@ -123,6 +148,9 @@ async def test_get_by_id_or_email_user(client,
     data_from_resp_by_email = resp_by_email.json()
     assert resp_by_email.status_code == 200
     assert data_from_resp_by_email['user_id'] != test_user_id
+    resp_by_email_upper = client.get(f"/user/get_by_id_or_email?user_id_or_email={test_user_email.upper()}",
+                                     headers=create_test_auth_headers_for_user(user_id=test_user_id))
+    assert resp_by_email_upper.json() == data_from_resp_by_email
     
     invalid_resp1 = client.get(f"/user/get_by_id_or_email?user_id_or_email=isnoteemail",
                             headers=create_test_auth_headers_for_user(user_id=user1_data['user_id']))
@@ -192,8 +220,25 @@ async def test_activate_deactivate_user(client,
     user_from_db = dict(users_from_db[0])
     assert user_from_db["is_active"] == False
 
+    # Деактивированный пользователь теряет доступ и не может активировать себя сам
     resp = client.patch(f"user/activate?user_id_or_email={user_from_db['user_id']}",
                         headers=create_test_auth_headers_for_user(user_from_db['user_id']))
+    assert resp.status_code == 401
+    resp = client.post("/auth/get_token",
+                       data={"username": user_data["email"], "password": "admin123"})
+    assert resp.status_code == 401
+
+    admin_id = uuid4()
+    await create_user_in_database(user_id=admin_id,
+                                  username="activateadmin",
+                                  name="activate",
+                                  surname="admin",
+                                  email="activateadmin@test.net",
+                                  hashed_password=hashed_password,
+                                  is_active=True,
+                                  roles=["ROLE_ADMIN"])
+    resp = client.patch(f"user/activate?user_id_or_email={user_from_db['user_id']}",
+                        headers=create_test_auth_headers_for_user(admin_id))
     assert resp.status_code == 200
     users_from_db = await get_user_from_database(user_data["user_id"])
     assert len(users_from_db) == 1
@@ -229,3 +274,664 @@ async def test_invalid_token(client):
     data_from_resp = resp.json()
     assert resp.status_code == 401
     assert data_from_resp == {"detail": "Could not validate credentials"}
+
+
+async def test_get_token(client, create_user_in_database):
+    hashed_password = await Hasher.get_password_hash_async(plain_password="admin123")
+    user_data = {"user_id": uuid4(),
+                 "username": "tokentest",
+                 "name": "token",
+                 "surname": "test",
+                 "email": "token@test.net",
+                 "hashed_password": hashed_password,
+                 "is_active": True}
+    await create_user_in_database(**user_data)
+    resp = client.post("/auth/get_token",
+                       data={"username": user_data["email"], "password": "admin123"})
+    assert resp.status_code == 200
+    token = resp.json()["access_token"]
+    resp = client.get("/user/me", headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 200
+    assert resp.json()["user_id"] == str(user_data["user_id"])
+
+    resp = client.post("/auth/get_token",
+                       data={"username": user_data["email"], "password": "wrong"})
+    assert resp.status_code == 401
+
+
+async def test_principal_cache_invalidation(client, create_user_in_database):
+    user_id, admin_id = uuid4(), uuid4()
+    for uid, username, roles in ((user_id, "cachetest", ["ROLE_USER"]),
+                                 (admin_id, "cacheadmin", ["ROLE_ADMIN"])):
+        await create_user_in_database(user_id=uid,
+                                      username=username,
+                                      name="cache",
+                                      surname="test",
+                                      email=f"{username}@test.net",
+                                      hashed_password="hashed",
+                                      is_active=True,
+                                      roles=roles)
+    headers = create_test_auth_headers_for_user(user_id=user_id)
+    resp = client.get("/user/me", headers=headers)
+    assert resp.status_code == 200
+    stats = principal_cache.stats()
+    resp = client.get("/user/me", headers=headers)
+    assert resp.status_code == 200
+    # Второй запрос берёт пользователя из кэша
+    assert (principal_cache.stats()["hits"], principal_cache.stats()["misses"]) == (stats["hits"] + 1,
+                                                                                    stats["misses"])
+
+    resp = client.patch(f"/user/deactivate?user_id_or_email={user_id}",
+                        headers=create_test_auth_headers_for_user(admin_id))
+    assert resp.status_code == 200
+    # Деактивация сбросила запись: пользователь перечитан из БД и отклонён
+    stats = principal_cache.stats()
+    resp = client.get("/user/me", headers=headers)
+    assert resp.status_code == 401
+    assert principal_cache.stats()["misses"] == stats["misses"] + 1
+    resp = client.get("/user/me", headers=headers)
+    assert resp.status_code == 401
+    assert principal_cache.stats()["hits"] == stats["hits"] + 1
+
+
+async def test_claims_mode_token_revocation(client, create_user_in_database, monkeypatch):
+    monkeypatch.setattr("api.auth.actions.JWT_CLAIMS_MODE", True)
+    hashed_password = Hasher.get_password_hash(plain_password="admin123")
+    user_data = {"user_id": uuid4(),
+                 "username": "claimstest",
+                 "name": "claims",
+                 "surname": "test",
+                 "email": "claims@test.net",
+                 "hashed_password": hashed_password,
+                 "is_active": True}
+    await create_user_in_database(**user_data)
+    resp = client.post("/auth/get_token",
+                       data={"username": user_data["email"], "password": "admin123"})
+    assert resp.status_code == 200
+    headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+    resp = client.get("/user/me", headers=headers)
+    assert resp.status_code == 200
+    assert resp.json()["email"] == user_data["email"]
+    assert "name" not in decode_access_token(headers["Authorization"].split()[1])
+
+    # Профиль после update виден со старым токеном: в claims его нет
+    resp = client.put(f"/user/update?user_id={user_data['user_id']}",
+                      content=json.dumps({"name": "renamed"}),
+                      headers=headers)
+    assert resp.status_code == 200
+    resp = client.get("/user/me", headers=headers)
+    assert resp.status_code == 200
+    assert resp.json()["name"] == "renamed"
+
+    resp = client.patch(f"/user/deactivate?user_id_or_email={user_data['user_id']}",
+                        headers=headers)
+    assert resp.status_code == 200
+    resp = client.get("/user/me", headers=headers)
+    assert resp.status_code == 401
+
+
+async def test_claims_mode_rejects_inactive_claim(client, create_user_in_database, monkeypatch):
+    monkeypatch.setattr("api.auth.actions.JWT_CLAIMS_MODE", True)
+    user_id = uuid4()
+    await create_user_in_database(user_id=user_id,
+                                  username="inactiveclaims",
+                                  name="inactive",
+                                  surname="claims",
+                                  email="inactiveclaims@test.net",
+                                  hashed_password="hashed",
+                                  is_active=True)
+    token = create_access_token(data={"sub": str(user_id), "ver": 0, "roles": ["ROLE_USER"], "is_active": False})
+    resp = client.get(f"/user/get_by_id_or_email?user_id_or_email={user_id}",
+                      headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 401
+
+
+async def test_claims_mode_deleted_user_revocation_persists(client, create_user_in_database,
+                                                          async_session_test, monkeypatch):
+    monkeypatch.setattr("api.auth.actions.JWT_CLAIMS_MODE", True)
+    user_data = {"user_id": uuid4(),
+                 "username": "deletedclaims",
+                 "name": "deleted",
+                 "surname": "claims",
+                 "email": "deletedclaims@test.net",
+                 "hashed_password": Hasher.get_password_hash(plain_password="admin123"),
+                 "is_active": True}
+    await create_user_in_database(**user_data)
+    resp = client.post("/auth/get_token",
+                       data={"username": user_data["email"], "password": "admin123"})
+    headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+    resp = client.delete(f"/user/delete/?user_id_or_email={user_data['user_id']}", headers=headers)
+    assert resp.status_code == 200
+
+    # Рестарт или другой воркер: в памяти отзывов нет, они восстанавливаются из БД
+    token_revocations.clear()
+    resp = client.get(f"/user/get_by_id_or_email?user_id_or_email={user_data['user_id']}", headers=headers)
+    assert resp.status_code == 404
+    async with async_session_test() as session:
+        async with session.begin():
+            rows = await UserCRUD(session).get_token_versions(deleted_within=timedelta(minutes=30))
+    token_revocations.load(rows)
+    resp = client.get(f"/user/get_by_id_or_email?user_id_or_email={user_data['user_id']}", headers=headers)
+    assert resp.status_code == 401
+
+
+async def test_refresh_token(client, create_user_in_database):
+    hashed_password = Hasher.get_password_hash(plain_password="admin123")
+    user_data = {"user_id": uuid4(),
+                 "username": "refreshtest",
+                 "name": "refresh",
+                 "surname": "test",
+                 "email": "refresh@test.net",
+                 "hashed_password": hashed_password,
+                 "is_active": True}
+    await create_user_in_database(**user_data)
+    resp = client.post("/auth/get_token",
+                       data={"username": user_data["email"], "password": "admin123"})
+    assert resp.status_code == 200
+    tokens = resp.json()
+    assert tokens["refresh_token"] != tokens["access_token"]
+
+    # refresh токен не принимается как access токен
+    resp = client.get("/user/me", headers={"Authorization": f"Bearer {tokens['refresh_token']}"})
+    assert resp.status_code == 401
+
+    resp = client.post("/auth/refresh", content=json.dumps({"refresh_token": tokens["refresh_token"]}))
+    assert resp.status_code == 200
+    new_tokens = resp.json()
+    resp = client.get("/user/me", headers={"Authorization": f"Bearer {new_tokens['access_token']}"})
+    assert resp.status_code == 200
+
+    # повторное использование старого refresh токена
+    resp = client.post("/auth/refresh", content=json.dumps({"refresh_token": tokens["refresh_token"]}))
+    assert resp.status_code == 401
+    # повтор в другом воркере или после рестарта: in-memory реестр пуст, отказ по БД
+    used_refresh_tokens.clear()
+    resp = client.post("/auth/refresh", content=json.dumps({"refresh_token": tokens["refresh_token"]}))
+    assert resp.status_code == 401
+
+    resp = client.patch(f"/user/deactivate?user_id_or_email={user_data['user_id']}",
+                        headers={"Authorization": f"Bearer {new_tokens['access_token']}"})
+    assert resp.status_code == 200
+    resp = client.post("/auth/refresh", content=json.dumps({"refresh_token": new_tokens["refresh_token"]}))
+    assert resp.status_code == 401
+
+
+async def test_refresh_token_survives_failed_transaction(client, create_user_in_database, monkeypatch):
+    user_data = {"user_id": uuid4(),
+                 "username": "refreshfail",
+                 "name": "refresh",
+                 "surname": "fail",
+                 "email": "refreshfail@test.net",
+                 "hashed_password": Hasher.get_password_hash(plain_password="admin123"),
+                 "is_active": True}
+    await create_user_in_database(**user_data)
+    resp = client.post("/auth/get_token",
+                       data={"username": user_data["email"], "password": "admin123"})
+    refresh_token = resp.json()["refresh_token"]
+    create_refresh_token = actions.create_refresh_token
+
+    def failing_create_refresh_token(**kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(actions, "create_refresh_token", failing_create_refresh_token)
+    resp = client.post("/auth/refresh", content=json.dumps({"refresh_token": refresh_token}))
+    assert resp.status_code != 200
+    # Транзакция откатилась: токен не считается использованным ни в БД, ни в памяти воркера
+    assert len(used_refresh_tokens) == 0
+    monkeypatch.setattr(actions, "create_refresh_token", create_refresh_token)
+    resp = client.post("/auth/refresh", content=json.dumps({"refresh_token": refresh_token}))
+    assert resp.status_code == 200
+    assert len(used_refresh_tokens) == 1
+
+
+async def test_login_throttling(client):
+    for _ in range(5):
+        resp = client.post("/auth/get_token",
+                           data={"username": "throttle@test.net", "password": "wrong"})
+        assert resp.status_code == 401
+    resp = client.post("/auth/get_token",
+                       data={"username": "Throttle@test.net", "password": "wrong"})
+    assert resp.status_code == 429
+    assert int(resp.headers["Retry-After"]) > 0
+
+
+async def test_legacy_hash_rehashed_on_login(client, create_user_in_database, get_user_from_database):
+    user_data = {"user_id": uuid4(),
+                 "username": "legacytest",
+                 "name": "legacy",
+                 "surname": "test",
+                 "email": "legacy@test.net",
+                 "hashed_password": hashlib.sha1(b"admin123").hexdigest(),
+                 "is_active": True}
+    await create_user_in_database(**user_data)
+    resp = client.post("/auth/get_token",
+                       data={"username": user_data["email"], "password": "admin123"})
+    assert resp.status_code == 200
+    user_from_db = dict((await get_user_from_database(user_data["user_id"]))[0])
+    assert user_from_db["hashed_password"].startswith("$2b$")
+    assert Hasher.verify_password("admin123", user_from_db["hashed_password"])
+
+
+async def test_get_all_users_cursor_pagination(client, create_user_in_database):
+    for i in range(3):
+        await create_user_in_database(user_id=uuid4(),
+                                      username=f"page{i}",
+                                      name="page",
+                                      surname="test",
+                                      email=f"page{i}@test.net",
+                                      hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                      is_active=True)
+    resp = client.get("/user/get_all_users?limit=2")
+    assert resp.status_code == 200
+    first_page = resp.json()
+    assert len(first_page) == 2
+    cursor = resp.headers["X-Next-Cursor"]
+
+    resp = client.get(f"/user/get_all_users?limit=2&cursor={cursor}")
+    assert resp.status_code == 200
+    second_page = resp.json()
+    assert len(second_page) == 1
+    assert "X-Next-Cursor" not in resp.headers
+    user_ids = [user["user_id"] for user in first_page + second_page]
+    assert user_ids == sorted(user_ids)
+
+    resp = client.get("/user/get_all_users?limit=2&offset=2")
+    assert resp.json() == second_page
+
+    resp = client.get("/user/get_all_users?limit=10&is_active=false")
+    assert resp.json() == []
+
+    resp = client.get("/user/get_all_users?limit=1&exact_count=true")
+    assert resp.status_code == 401
+    admin_id = uuid4()
+    await create_user_in_database(user_id=admin_id,
+                                  username="pageadmin",
+                                  name="page",
+                                  surname="admin",
+                                  email="pageadmin@test.net",
+                                  hashed_password="hashed",
+                                  is_active=True,
+                                  roles=["ROLE_ADMIN"])
+    admin_headers = create_test_auth_headers_for_user(admin_id)
+    resp = client.get("/user/get_all_users?limit=1&exact_count=true", headers=admin_headers)
+    assert resp.headers["X-Total-Count"] == "4"
+    assert resp.headers["X-Total-Count-Estimated"] == "false"
+    resp = client.get("/user/get_all_users?limit=1&is_active=true&exact_count=true", headers=admin_headers)
+    assert resp.headers["X-Total-Count"] == "4"
+    resp = client.get("/user/get_all_users?limit=1")
+    assert int(resp.headers["X-Total-Count"]) >= 0
+
+    resp = client.get("/user/get_all_users?limit=100000")
+    assert resp.status_code == 422
+    resp = client.get("/user/get_all_users?cursor=notacursor")
+    assert resp.status_code == 422
+
+
+async def test_export_users(client, create_user_in_database):
+    admin_id = uuid4()
+    await create_user_in_database(user_id=admin_id,
+                                  username="exportadmin",
+                                  name="export",
+                                  surname="admin",
+                                  email="exportadmin@test.net",
+                                  hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                  is_active=True,
+                                  roles=["ROLE_ADMIN"])
+    user_id = uuid4()
+    await create_user_in_database(user_id=user_id,
+                                  username="exportuser",
+                                  name="export",
+                                  surname="user",
+                                  email="exportuser@test.net",
+                                  hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                  is_active=True)
+    resp = client.get("/user/export", headers=create_test_auth_headers_for_user(admin_id))
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in resp.text.splitlines()]
+    assert {row["user_id"] for row in rows} == {str(admin_id), str(user_id)}
+
+    resp = client.get("/user/export?format=csv", headers=create_test_auth_headers_for_user(admin_id))
+    assert resp.status_code == 200
+    lines = resp.text.splitlines()
+    assert lines[0] == "user_id,username,name,surname,email,is_active,roles"
+    assert len(lines) == 3
+
+    resp = client.get("/user/export", headers=create_test_auth_headers_for_user(user_id))
+    assert resp.status_code == 403
+
+
+async def test_search_users(client, create_user_in_database, asyncpg_pool):
+    async with asyncpg_pool.acquire() as connection:
+        if not await connection.fetchval("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"):
+            pytest.skip("pg_trgm is not installed")
+    admin_id = uuid4()
+    await create_user_in_database(user_id=admin_id,
+                                  username="searchadmin",
+                                  name="Admin",
+                                  surname="Root",
+                                  email="searchadmin@test.net",
+                                  hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                  is_active=True,
+                                  roles=["ROLE_ADMIN"])
+    user_id = uuid4()
+    await create_user_in_database(user_id=user_id,
+                                  username="konstantin",
+                                  name="Konstantin",
+                                  surname="Ivanov",
+                                  email="kostya@test.net",
+                                  hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                  is_active=True)
+    headers = create_test_auth_headers_for_user(admin_id)
+    resp = client.get("/user/search?q=IVAN", headers=headers)
+    assert resp.status_code == 200
+    assert [user["user_id"] for user in resp.json()] == [str(user_id)]
+    # опечатка
+    resp = client.get("/user/search?q=konstatin", headers=headers)
+    assert [user["user_id"] for user in resp.json()] == [str(user_id)]
+    resp = client.get("/user/search?q=test.net&limit=1&offset=1", headers=headers)
+    assert len(resp.json()) == 1
+    resp = client.get("/user/search", params={"q": "a%_"}, headers=headers)
+    assert resp.json() == []
+
+    resp = client.get("/user/search?q=iv", headers=headers)
+    assert resp.status_code == 422
+    resp = client.get("/user/search?q=ivan", headers=create_test_auth_headers_for_user(user_id))
+    assert resp.status_code == 403
+
+
+async def test_exact_count_fallback_is_cached(client, monkeypatch):
+    counts = []
+
+    async def no_estimate(self, is_active):
+        return None
+
+    async def count(self, is_active, timeout_ms):
+        counts.append(is_active)
+        return 7
+
+    monkeypatch.setattr("db.crud.UserCRUD.estimate_count", no_estimate)
+    monkeypatch.setattr("db.crud.UserCRUD.count", count)
+    resp = client.get("/user/get_all_users?limit=1")
+    assert (resp.headers["X-Total-Count"], resp.headers["X-Total-Count-Estimated"]) == ("7", "false")
+    users_page_cache.clear()
+    resp = client.get("/user/get_all_users?limit=1")
+    assert (resp.headers["X-Total-Count"], resp.headers["X-Total-Count-Estimated"]) == ("7", "true")
+    assert counts == [None]
+
+
+async def test_bulk_create_users(client, create_user_in_database, get_user_from_database):
+    admin_id = uuid4()
+    await create_user_in_database(user_id=admin_id,
+                                  username="bulkadmin",
+                                  name="bulk",
+                                  surname="admin",
+                                  email="bulkadmin@test.net",
+                                  hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                  is_active=True,
+                                  roles=["ROLE_ADMIN"])
+    items = [{"username": "bulk1", "name": "bulk", "surname": "one",
+              "email": "bulk1@test.net", "password": "admin123"},
+             {"username": "bulk2", "name": "bulk", "surname": "two",
+              "email": "bulk2@test.net", "password": "admin123"},
+             {"username": "bulk3", "name": "bulk", "surname": "three",
+              "email": "bulk1@test.net", "password": "admin123"},
+             {"username": "bulkadmin2", "name": "bulk", "surname": "four",
+              "email": "bulkadmin@test.net", "password": "admin123"},
+             {"username": "!@#", "name": "bulk", "surname": "five",
+              "email": "bulk5@test.net", "password": "admin123"}]
+    resp = client.post("/user/bulk_create", content=json.dumps(items),
+                       headers=create_test_auth_headers_for_user(admin_id))
+    assert resp.status_code == 200
+    data = resp.json()
+    assert (data["created"], data["duplicates"], data["invalid"]) == (2, 2, 1)
+    assert [item["status"] for item in data["items"]] == ["created", "created", "duplicate",
+                                                         "duplicate", "invalid"]
+    users_from_db = await get_user_from_database(data["items"][0]["user_id"])
+    assert dict(users_from_db[0])["email"] == "bulk1@test.net"
+
+
+async def test_bulk_create_hashing_failure_is_per_item(client, create_user_in_database, monkeypatch):
+    admin_id = uuid4()
+    await create_user_in_database(user_id=admin_id,
+                                  username="bulkfailadmin",
+                                  name="bulk",
+                                  surname="admin",
+                                  email="bulkfailadmin@test.net",
+                                  hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                  is_active=True,
+                                  roles=["ROLE_ADMIN"])
+    get_password_hash_async = Hasher.get_password_hash_async
+
+    async def flaky_hash(plain_password):
+        if plain_password == "overload1":
+            raise HTTPException(status_code=503, detail="Server is busy, try again later")
+        return await get_password_hash_async(plain_password=plain_password)
+
+    monkeypatch.setattr(Hasher, "get_password_hash_async", staticmethod(flaky_hash))
+    items = [{"username": "bulkok", "name": "bulk", "surname": "ok",
+              "email": "bulkok@test.net", "password": "admin123"},
+             {"username": "bulkbusy", "name": "bulk", "surname": "busy",
+              "email": "bulkbusy@test.net", "password": "overload1"}]
+    resp = client.post("/user/bulk_create", content=json.dumps(items),
+                       headers=create_test_auth_headers_for_user(admin_id))
+    assert resp.status_code == 200
+    data = resp.json()
+    assert (data["created"], data["failed"]) == (1, 1)
+    assert [item["status"] for item in data["items"]] == ["created", "failed"]
+    assert data["items"][1]["detail"] == "Server is busy, try again later"
+
+
+async def test_bulk_mutations(client, create_user_in_database, get_user_from_database):
+    users = {}
+    for name, roles in (("admin", ["ROLE_ADMIN"]), ("otheradmin", ["ROLE_ADMIN"]),
+                        ("user1", ["ROLE_USER"]), ("user2", ["ROLE_USER"])):
+        users[name] = uuid4()
+        await create_user_in_database(user_id=users[name],
+                                      username=f"bulk{name}",
+                                      name="bulk",
+                                      surname="test",
+                                      email=f"bulk{name}@test.net",
+                                      hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                      is_active=True,
+                                      roles=roles)
+    headers = create_test_auth_headers_for_user(users["admin"])
+    body = {"users": [str(users["user1"]), "bulkuser2@test.net", str(users["otheradmin"]),
+                      "missing@test.net"]}
+    resp = client.patch("/user/bulk_deactivate", content=json.dumps(body), headers=headers)
+    assert resp.status_code == 200
+    data = resp.json()
+    assert sorted(data["changed"]) == sorted([str(users["user1"]), str(users["user2"])])
+    assert data["forbidden"] == [str(users["otheradmin"])]
+    assert data["not_found"] == ["missing@test.net"]
+    user_from_db = dict((await get_user_from_database(users["user1"]))[0])
+    assert user_from_db["is_active"] is False
+
+    resp = client.patch("/user/bulk_deactivate", content=json.dumps(body), headers=headers)
+    assert resp.json()["skipped"] == [str(users["user1"]), "bulkuser2@test.net"]
+
+    resp = client.request("DELETE", "/user/bulk_delete", content=json.dumps(body), headers=headers)
+    assert resp.status_code == 200
+    assert len(resp.json()["changed"]) == 2
+    assert len(await get_user_from_database(users["user1"])) == 0
+
+    resp = client.patch("/user/bulk_activate", content=json.dumps({"users": [str(users["admin"])]}),
+                        headers=create_test_auth_headers_for_user(users["user2"]))
+    assert resp.status_code == 401
+
+
+async def test_mutation_not_found_and_forbidden(client, create_user_in_database):
+    user_ids = []
+    for i in range(2):
+        user_ids.append(uuid4())
+        await create_user_in_database(user_id=user_ids[i],
+                                      username=f"mutation{i}",
+                                      name="mutation",
+                                      surname="test",
+                                      email=f"mutation{i}@test.net",
+                                      hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                      is_active=True)
+    headers = create_test_auth_headers_for_user(user_ids[0])
+    resp = client.patch(f"/user/deactivate?user_id_or_email={user_ids[1]}", headers=headers)
+    assert resp.status_code == 403
+    resp = client.delete(f"/user/delete?user_id_or_email=mutation1@test.net", headers=headers)
+    assert resp.status_code == 403
+    resp = client.delete(f"/user/delete?user_id_or_email={uuid4()}", headers=headers)
+    assert resp.status_code == 404
+    assert resp.json() == {"detail": "User not found"}
+    resp = client.patch(f"/user/activate?user_id_or_email={user_ids[0]}", headers=headers)
+    assert resp.status_code == 404
+    assert resp.json() == {"detail": "User not found or active"}
+
+
+async def test_metrics(client, create_user_in_database):
+    resp = client.get("/metrics/db_pool")
+    assert resp.status_code == 401
+    user_id, admin_id = uuid4(), uuid4()
+    for uid, username, roles in ((user_id, "metricsuser", ["ROLE_USER"]),
+                                 (admin_id, "metricsadmin", ["ROLE_ADMIN"])):
+        await create_user_in_database(user_id=uid,
+                                      username=username,
+                                      name="metrics",
+                                      surname="test",
+                                      email=f"{username}@test.net",
+                                      hashed_password="hashed",
+                                      is_active=True,
+                                      roles=roles)
+    resp = client.get("/metrics/db_pool", headers=create_test_auth_headers_for_user(user_id))
+    assert resp.status_code == 403
+    headers = create_test_auth_headers_for_user(admin_id)
+    resp = client.get("/metrics/db_pool", headers=headers)
+    assert resp.status_code == 200
+    assert {"checked_out", "idle", "overflow", "checkout_timeouts", "wait_seconds_max"} <= set(resp.json()["primary"])
+    resp = client.get("/metrics/caches", headers=headers)
+    assert resp.status_code == 200
+    assert "hit_rate" in resp.json()["principals"]
+
+
+async def test_openapi_keeps_user_schemas(client):
+    paths = client.get("/openapi.json").json()["paths"]
+    for path in ("/user/get_all_users", "/user/search"):
+        schema = paths[path]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+        assert schema["items"]["$ref"] == "#/components/schemas/GetUser"
+    schema = paths["/user/get_by_id_or_email"]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+    assert schema["$ref"] == "#/components/schemas/GetUser"
+
+
+async def test_etags_and_conditional_update(client, create_user_in_database):
+    user_id = uuid4()
+    await create_user_in_database(user_id=user_id,
+                                  username="etaguser",
+                                  name="Etag",
+                                  surname="User",
+                                  email="etag@test.net",
+                                  hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                  is_active=True)
+    headers = create_test_auth_headers_for_user(user_id)
+    resp = client.get(f"/user/get_by_id_or_email?user_id_or_email={user_id}", headers=headers)
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+    resp = client.get(f"/user/get_by_id_or_email?user_id_or_email={user_id}",
+                      headers={**headers, "If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.content == b""
+    resp = client.get("/user/me", headers={**headers, "If-None-Match": etag})
+    assert resp.status_code == 304
+
+    resp = client.get(f"/user/get_by_id_or_email?user_id_or_email={user_id}",
+                      headers={**headers, "If-None-Match": "W/" + etag})
+    assert resp.status_code == 304
+    # Слабый тег не удовлетворяет If-Match
+    resp = client.put(f"/user/update?user_id={user_id}", content=json.dumps({"name": "Weak"}),
+                      headers={**headers, "If-Match": "W/" + etag})
+    assert resp.status_code == 412
+
+    resp = client.put(f"/user/update?user_id={user_id}", content=json.dumps({"name": "Changed"}),
+                      headers={**headers, "If-Match": etag})
+    assert resp.status_code == 200
+    new_etag = resp.headers["ETag"]
+    assert new_etag != etag
+    resp = client.put(f"/user/update?user_id={user_id}", content=json.dumps({"name": "Lost"}),
+                      headers={**headers, "If-Match": etag})
+    assert resp.status_code == 412
+    resp = client.get(f"/user/get_by_id_or_email?user_id_or_email={user_id}",
+                      headers={**headers, "If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.json()["name"] == "Changed"
+    assert resp.headers["ETag"] == new_etag
+
+
+async def test_users_page_cache(client, create_user_in_database):
+    user_id = uuid4()
+    await create_user_in_database(user_id=user_id,
+                                  username="pagecache",
+                                  name="Page",
+                                  surname="Cache",
+                                  email="pagecache@test.net",
+                                  hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                  is_active=True)
+    first = client.get("/user/get_all_users?limit=5")
+    hits = users_page_cache.hits
+    second = client.get("/user/get_all_users?limit=5")
+    assert users_page_cache.hits == hits + 1
+    assert second.content == first.content
+    assert second.headers["X-Total-Count"] == first.headers["X-Total-Count"]
+
+    resp = client.put(f"/user/update?user_id={user_id}", content=json.dumps({"name": "Renamed"}),
+                      headers=create_test_auth_headers_for_user(user_id))
+    assert resp.status_code == 200
+    resp = client.get("/user/get_all_users?limit=5")
+    assert resp.json()[0]["name"] == "Renamed"
+    assert users_page_cache.hits == hits + 1
+
+
+async def test_batch_get_users(client, create_user_in_database):
+    user_ids = [uuid4(), uuid4()]
+    for i, user_id in enumerate(user_ids):
+        await create_user_in_database(user_id=user_id,
+                                      username=f"batch{i}",
+                                      name="Batch",
+                                      surname="User",
+                                      email=f"batch{i}@test.net",
+                                      hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                      is_active=True)
+    missing_id = str(uuid4())
+    keys = ["BATCH1@test.net", str(user_ids[0]), missing_id, "nobody@test.net", str(user_ids[0])]
+    resp = client.post("/user/batch_get", content=json.dumps({"users": keys}),
+                       headers=create_test_auth_headers_for_user(user_ids[0]))
+    assert resp.status_code == 200
+    items = resp.json()["items"]
+    assert [item["found"] for item in items] == [True, True, False, False, True]
+    assert items[0]["user"]["user_id"] == str(user_ids[1])
+    assert items[1]["user"]["email"] == "batch0@test.net"
+    assert items[2] == {"key": missing_id, "found": False, "user": None}
+    assert items[4] == items[1]
+
+    resp = client.post("/user/batch_get", content=json.dumps({"users": []}),
+                       headers=create_test_auth_headers_for_user(user_ids[0]))
+    assert resp.status_code == 422
+
+
+async def test_single_lookups_share_loader(async_session_test, create_user_in_database):
+    user_ids = [uuid4(), uuid4()]
+    for i, user_id in enumerate(user_ids):
+        await create_user_in_database(user_id=user_id,
+                                      username=f"single{i}",
+                                      name="Single",
+                                      surname="User",
+                                      email=f"single{i}@test.net",
+                                      hashed_password=Hasher.get_password_hash(plain_password="admin123"),
+                                      is_active=True)
+    async with async_session_test() as session:
+        loader = get_user_loader(db=session)
+        by_id, by_email, other, missing = await asyncio.gather(
+            get_by_id_or_email(user_id_or_email=user_ids[0], loader=loader),
+            get_by_id_or_email(user_id_or_email="SINGLE0@test.net", loader=loader),
+            get_by_id_or_email(user_id_or_email=user_ids[1], loader=loader),
+            get_by_id_or_email(user_id_or_email=uuid4(), loader=loader))
+    assert loader.batches == 1
+    assert by_id == by_email
+    assert "version" not in by_id[0]
+    assert by_id[1] == f'"{user_ids[0]}.0"'
+    assert other[0]["username"] == "single1"
+    assert missing is None
@@ -0,0 +1,79 @@
+import hashlib
+import pytest
+import pytest_asyncio
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.expression import ClauseElement
+from uuid import UUID
+
+from db import crud
+from api.auth.actions import _user_permissions_clause
+
+
+SYNTHETIC_USERS = 50000
+# user_id первой синтетической строки: md5(1::text)::uuid
+KNOWN_ID = UUID(hashlib.md5(b"1").hexdigest())
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN " + compiler.process(element.statement, **kw)
+
+
+@pytest_asyncio.fixture
+async def synthetic_users(async_session_test):
+    async with async_session_test() as session:
+        async with session.begin():
+            await session.execute(text(
+                """INSERT INTO users (user_id, username, name, surname, email, hashed_password, roles, is_active)
+                   SELECT md5(i::text)::uuid, 'user' || i, 'Name', 'Surname', 'User' || i || '@example.com',
+                          'hash', '{ROLE_USER}', i % 10 <> 0
+                   FROM generate_series(1, :count) AS i"""), {"count": SYNTHETIC_USERS})
+        await session.execute(text("ANALYZE users"))
+        yield session
+
+
+PLAN_CASES = {
+    "get_by_id": (crud.GET_BY_ID, {"user_id": KNOWN_ID}),
+    "get_by_email": (crud.GET_BY_EMAIL, {"email": "user1@example.com"}),
+    "get_view_by_id": (crud.GET_VIEW_BY_ID, {"user_id": KNOWN_ID}),
+    "get_view_by_email": (crud.GET_VIEW_BY_EMAIL, {"email": "user1@example.com"}),
+    "conflicting_fields": (crud.GET_CONFLICTING_FIELDS, {"email": "user1@example.com", "username": "user2"}),
+    "list_offset": (crud._list_statement(keyset=False, filter_active=False), {"limit": 11, "offset": 100}),
+    "list_keyset": (crud._list_statement(keyset=True, filter_active=False), {"limit": 11, "after_user_id": KNOWN_ID}),
+    "list_inactive": (crud._list_statement(keyset=False, filter_active=True),
+                      {"limit": 11, "offset": 0, "is_active": False}),
+    "list_inactive_keyset": (crud._list_statement(keyset=True, filter_active=True),
+                             {"limit": 11, "after_user_id": KNOWN_ID, "is_active": False}),
+}
+for _action in crud.MUTATION_ACTIONS:
+    for _is_admin in (False, True):
+        PLAN_CASES[f"mutate_{_action}_{'admin' if _is_admin else 'user'}"] = (
+            crud._mutation_statement(_action, _user_permissions_clause(is_admin=_is_admin)),
+            {"user_ids": [KNOWN_ID], "emails": ["user2@example.com"], "current_user_id": KNOWN_ID})
+
+
+PLAN_CASES["get_views_by_ids_or_emails"] = (crud.GET_VIEWS_BY_IDS_OR_EMAILS,
+                                            {"user_ids": [KNOWN_ID], "emails": ["user2@example.com"]})
+PLAN_CASES["search"] = (crud.SEARCH_USERS, {"query": "user123", "pattern": "%user123%", "limit": 10, "offset": 0})
+
+
+@pytest.mark.parametrize("case", PLAN_CASES)
+async def test_crud_query_uses_index(synthetic_users, case):
+    statement, params = PLAN_CASES[case]
+    if case == "search":
+        res = await synthetic_users.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"))
+        if res.scalar() is None:
+            pytest.skip("pg_trgm is not installed")
+    res = await synthetic_users.execute(Explain(statement), params)
+    plan = "\n".join(row[0] for row in res.fetchall())
+    assert "Seq Scan" not in plan, plan
+    assert "Index" in plan, plan
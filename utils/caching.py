@@ -0,0 +1,121 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """ LRU-кэш в памяти процесса с ограниченным размером и временем жизни записей """
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            self.misses += 1
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            self._delete(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """ ttl переопределяет время жизни записи, но не больше общего ttl кэша """
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self._delete(key)
+        self._store(key, value, time.monotonic() + ttl)
+        while self._over_limit():
+            self._delete(next(iter(self._data)))
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        self._delete(key)
+
+    def _store(self, key: Hashable, value: Any, expires_at: float) -> None:
+        self._data[key] = (value, expires_at)
+
+    def _delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def _over_limit(self) -> bool:
+        return len(self._data) > self.maxsize
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+class ResponseCache(TTLCache):
+    """ Кэш сериализованных ответов (body, headers) с ограничением по числу записей и по байтам.
+
+    Ключи включают generation: bump() делает все прежние записи недостижимыми,
+    они вытесняются по LRU или истекают по ttl
+    """
+    def __init__(self, maxsize: int, ttl: float, maxbytes: int) -> None:
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.generation = 0
+        self._sizes: dict = {}
+
+    def bump(self) -> None:
+        self.generation += 1
+
+    def set(self, key: Hashable, value: tuple[bytes, dict], ttl: Optional[float] = None) -> None:
+        if self._sizeof(value) > self.maxbytes:
+            return
+        super().set(key, value, ttl)
+
+    def clear(self) -> None:
+        super().clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+    @staticmethod
+    def _sizeof(value: tuple[bytes, dict]) -> int:
+        body, headers = value
+        return len(body) + sum(len(name) + len(header) for name, header in headers.items())
+
+    def _store(self, key: Hashable, value: Any, expires_at: float) -> None:
+        super()._store(key, value, expires_at)
+        self._sizes[key] = self._sizeof(value)
+        self.bytes += self._sizes[key]
+
+    def _delete(self, key: Hashable) -> None:
+        super()._delete(key)
+        self.bytes -= self._sizes.pop(key, 0)
+
+    def _over_limit(self) -> bool:
+        return super()._over_limit() or self.bytes > self.maxbytes
+
+    def stats(self) -> dict:
+        return {**super().stats(),
+                "bytes": self.bytes,
+                "maxbytes": self.maxbytes,
+                "generation": self.generation}
@@ -0,0 +1,51 @@
+""" Подбор стоимости bcrypt под текущее железо.
+
+python -m utils.calibrate_bcrypt --target-ms 250
+
+Выводит максимальное число rounds, при котором медианное время одного хэша
+не превышает целевое. Результат задаётся через переменную BCRYPT_ROUNDS.
+"""
+import argparse
+import statistics
+import time
+
+from passlib.hash import bcrypt
+
+
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+
+
+def measure(rounds: int, samples: int) -> float:
+    """ Медианное время хэширования в миллисекундах """
+    handler = bcrypt.using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        handler.hash("calibration-password")
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def calibrate(target_ms: float, samples: int) -> int:
+    chosen = MIN_ROUNDS
+    for rounds in range(MIN_ROUNDS, MAX_ROUNDS + 1):
+        elapsed = measure(rounds, samples)
+        print(f"rounds={rounds:<3} {elapsed:8.1f} ms")
+        if elapsed > target_ms:
+            break
+        chosen = rounds
+    return chosen
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Calibrate bcrypt cost for this host")
+    parser.add_argument("--target-ms", type=float, default=250, help="target time of one hash")
+    parser.add_argument("--samples", type=int, default=5, help="hashes per rounds value")
+    args = parser.parse_args()
+    rounds = calibrate(target_ms=args.target_ms, samples=args.samples)
+    print(f"\nBCRYPT_ROUNDS={rounds}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class DataLoader:
+    """ Собирает load(key), вызванные в одном проходе event loop, в один вызов batch_load.
+
+    batch_load(keys) получает список уникальных ключей и возвращает dict ключ -> значение;
+    для отсутствующих ключей load возвращает None. Пачки выполняются по очереди, поэтому
+    batch_load может пользоваться одной сессией БД.
+    """
+    def __init__(self,
+                 batch_load: Callable[[list], Awaitable[dict]],
+                 max_batch_size: Optional[int] = None) -> None:
+        self.batch_load = batch_load
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self._queue: dict[Hashable, asyncio.Future] = {}
+        self._lock = asyncio.Lock()
+
+    def load(self, key: Hashable) -> Awaitable[Any]:
+        future = self._queue.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self._queue:
+                # Пачка отправляется после всех корутин, готовых в этом проходе loop
+                loop.call_soon(self._dispatch)
+            future = loop.create_future()
+            self._queue[key] = future
+        # Future общий для всех, кто ждёт этот ключ: отмена одного вызывающего не должна отменять остальных
+        return asyncio.shield(future)
+
+    async def load_many(self, keys: list[Hashable]) -> list[Any]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def _dispatch(self) -> None:
+        queue, self._queue = self._queue, {}
+        items = list(queue.items())
+        step = self.max_batch_size or len(items)
+        for start in range(0, len(items), step):
+            asyncio.ensure_future(self._run(dict(items[start:start + step])))
+
+    async def _run(self, batch: dict[Hashable, asyncio.Future]) -> None:
+        try:
+            async with self._lock:
+                self.batches += 1
+                results = await self.batch_load(list(batch))
+        except asyncio.CancelledError:
+            for future in batch.values():
+                future.cancel()
+            raise
+        except Exception as err:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
@@ -0,0 +1,31 @@
+from typing import Optional
+
+
+def make_etag(*parts) -> str:
+    """ Сильный ETag из частей (например, user_id и версии строки) """
+    return '"' + ".".join(str(part) for part in parts) + '"'
+
+
+def parse_etags(header: Optional[str], weak: bool = False) -> list[str]:
+    """ Теги из If-Match / If-None-Match.
+
+    weak=False - сильное сравнение (If-Match): слабые теги W/ никогда не совпадают и отбрасываются.
+    weak=True - слабое сравнение (If-None-Match): у слабых тегов отбрасывается префикс W/
+    """
+    if not header:
+        return []
+    tags = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag:
+            tags.append(tag)
+    return tags
+
+
+def etag_matches(header: Optional[str], etag: str, weak: bool = False) -> bool:
+    tags = parse_etags(header, weak=weak)
+    return "*" in tags or etag in tags
@@ -1,14 +1,117 @@
+import asyncio
+import weakref
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
 
+from settings import (
+    HASHER_EXECUTOR,
+    HASHER_WORKERS,
+    HASHER_MAX_PENDING,
+    HASHER_QUEUE_TIMEOUT,
+    BCRYPT_ROUNDS
+)
+
+
+# hex_sha1 - устаревшие хэши из db/create_test_data.sql, переводятся в bcrypt при входе.
+# Хэши bcrypt с другим числом rounds тоже пересчитываются (needs_update)
+pwd_context = CryptContext(schemes=["bcrypt", "hex_sha1"],
+                           deprecated="auto",
+                           bcrypt__default_rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS,
+                           bcrypt__max_rounds=BCRYPT_ROUNDS)
+
+
+def _hash(plain_password: str) -> str:
+    return pwd_context.hash(plain_password)
+
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _verify_and_update(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    try:
+        return pwd_context.verify_and_update(plain_password, hashed_password)
+    except ValueError:
+        # Формат хэша не распознан
+        return False, None
+
+
+class HashingPool:
+    """ Ограниченный пул для bcrypt, чтобы не блокировать event loop.
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    Одновременно в пуле не больше max_pending задач (выполняются + ждут
+    свободного воркера). Если место не освободилось за queue_timeout секунд,
+    запрос отклоняется с 503.
+    """
+    def __init__(self, executor_type: str, workers: int, max_pending: int, queue_timeout: float) -> None:
+        self.executor_type = executor_type
+        self.workers = workers
+        self.max_pending = max(max_pending, workers)
+        self.queue_timeout = queue_timeout
+        self._executor: Optional[Executor] = None
+        # Семафор привязан к event loop, поэтому храним свой на каждый loop
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_type == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='hasher')
+        return self._executor
+
+    def _get_semaphore(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_pending)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    async def run(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        semaphore = self._get_semaphore(loop)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Server is busy, try again later",
+                                headers={"Retry-After": str(max(int(self.queue_timeout), 1))})
+        try:
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            semaphore.release()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hashing_pool = HashingPool(executor_type=HASHER_EXECUTOR,
+                           workers=HASHER_WORKERS,
+                           max_pending=HASHER_MAX_PENDING,
+                           queue_timeout=HASHER_QUEUE_TIMEOUT)
 
 
 class Hasher:
     @staticmethod
     def verify_password(plain_password, hashed_password):
-        return pwd_context.verify(plain_password, hashed_password)
-    
+        return _verify(plain_password, hashed_password)
+
     @staticmethod
     def get_password_hash(plain_password):
-        return pwd_context.hash(plain_password)
+        return _hash(plain_password)
+
+    @staticmethod
+    async def verify_and_update_async(plain_password, hashed_password) -> Tuple[bool, Optional[str]]:
+        """ Возвращает (пароль верный, новый хэш или None, если пересчёт не нужен) """
+        return await hashing_pool.run(_verify_and_update, plain_password, hashed_password)
+
+    @staticmethod
+    async def get_password_hash_async(plain_password) -> str:
+        return await hashing_pool.run(_hash, plain_password)
@@ -0,0 +1,14 @@
+from typing import Any
+
+import orjson
+from fastapi.responses import ORJSONResponse
+
+
+class RowsJSONResponse(ORJSONResponse):
+    """ JSON ответ из строк БД без pydantic и jsonable_encoder.
+
+    asyncpg возвращает uuid как asyncpg.pgproto.UUID, который orjson не знает,
+    такие значения приводятся к строке через default
+    """
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=str)
@@ -0,0 +1,73 @@
+import abc
+import math
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException, status
+
+
+class ThrottleStorage(abc.ABC):
+    """ Хранилище token bucket счётчиков.
+
+    Реализация в памяти работает в пределах одного процесса; чтобы воркеры делили
+    лимиты, достаточно реализовать consume поверх общего хранилища (например, Redis).
+    """
+    @abc.abstractmethod
+    async def consume(self, key: str, rate: float, capacity: float, cost: float = 1) -> float:
+        """ Списывает cost токенов. Возвращает 0 при успехе, иначе сколько секунд ждать """
+
+
+class InMemoryThrottleStorage(ThrottleStorage):
+    def __init__(self, max_keys: int) -> None:
+        self.max_keys = max_keys
+        self._buckets: OrderedDict = OrderedDict()
+
+    async def consume(self, key: str, rate: float, capacity: float, cost: float = 1) -> float:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        if tokens >= cost:
+            tokens -= cost
+            retry_after = 0.0
+        else:
+            retry_after = (cost - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+
+class LoginThrottler:
+    """ Ограничивает попытки входа по email и по клиенту до проверки пароля """
+    def __init__(self,
+                 storage: ThrottleStorage,
+                 email_per_minute: float,
+                 email_burst: float,
+                 client_per_minute: float,
+                 client_burst: float,
+                 enabled: bool = True) -> None:
+        self.storage = storage
+        self.email_rate = email_per_minute / 60
+        self.email_burst = email_burst
+        self.client_rate = client_per_minute / 60
+        self.client_burst = client_burst
+        self.enabled = enabled
+
+    async def check(self, email: str, client: str) -> None:
+        if not self.enabled:
+            return
+        retry_after = await self.storage.consume(f"login:client:{client}",
+                                                 rate=self.client_rate,
+                                                 capacity=self.client_burst)
+        if not retry_after:
+            retry_after = await self.storage.consume(f"login:email:{email.strip().lower()}",
+                                                     rate=self.email_rate,
+                                                     capacity=self.email_burst)
+        if retry_after:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                detail="Too many login attempts",
+                                headers={"Retry-After": str(math.ceil(retry_after))})